@@ -1,95 +1,176 @@
 #! /usr/bin/python
 
+import os
 import sys
 import getopt
 import re
+import array
+import hashlib
+
+# Side file helpers are shared with the tools in ../parser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    os.pardir, "parser"))
+import sideFile
+
+# Version of the format written by ProgramFunctionCalls to its cache
+CACHE_VERSION = 3
 
 def debug(debug_out):
     sys.stderr.write(debug_out)
 
-class FunctionCalls:
-    """Information about a function."""
+class CallGraph:
+    """Compact call graph of the functions in one source file.
 
-    def __init__(self, fname, is_inline, file):
-        """Set barebones function information.
+    Function names are interned to integer ids.  Functions are numbered
+    in the order they are first seen as a caller, and their ids and
+    inline status are kept in parallel arrays.  The targets called by
+    function i are stored, in the order they are called, in
+    call_targets[call_offsets[i]:call_offsets[i + 1]].
 
-        - fname is the name of the function
-        - calls made by the function begins empty
-        - is_inline is true if this is an inline function
-        - file is the name of the file containing the function
-        """
+    Lines are added with add_lines and the arrays are built by finish.
+    """
 
-        self.name = fname
-        self.calls = []
-        self.is_inline = is_inline
+    def __init__(self, file):
         self.file = file
+        self.names = []
+        self.function_ids = array.array("l")
+        self.function_inline = array.array("b")
+        self.call_offsets = array.array("l", [0])
+        self.call_targets = array.array("l")
 
+        # Build state that is discarded by finish
+        self.name_ids = {}
+        self.function_index = {}
+        self.edge_functions = array.array("l")
+        self.edge_targets = array.array("l")
 
-    def makes_call(self, called_function):
-        """Add called_function to list of functions called by this function."""
-        self.calls.append(called_function)
 
+    def add_lines(self, lines):
+        """Add lines of a raw call file for this source file.
 
-    def __str__(self):
-        """Print information about this function."""
-        output = ""
-        if self.is_inline == True:
-            output += "%s (inline):\n" % (self.name)
-        elif self.is_line == None:
-            output += "%s (unknown inline status):\n" % (self.name)
+        Each line is given as its list of fields.
+        """
+
+        names = self.names
+        get_name_id = self.name_ids.get
+        name_ids = self.name_ids
+        get_function = self.function_index.get
+        function_index = self.function_index
+        function_ids = self.function_ids
+        edge_functions = self.edge_functions
+        edge_targets = self.edge_targets
+
+        function_inline = self.function_inline
+
+        for (inline_str, caller_file, caller, target) in lines:
+            is_inline = (inline_str == "true" or inline_str == "True" or
+                    inline_str == "TRUE")
+            function = get_function(caller)
+            if function == None:
+                caller_id = get_name_id(caller)
+                if caller_id == None:
+                    caller_id = name_ids[caller] = len(names)
+                    names.append(caller)
+                function = function_index[caller] = len(function_ids)
+                function_ids.append(caller_id)
+                function_inline.append(is_inline)
+            else:
+                assert function_inline[function] == is_inline
+
+            if target == "__DECLARATION__":
+                continue
+
+            target_id = get_name_id(target)
+            if target_id == None:
+                target_id = name_ids[target] = len(names)
+                names.append(target)
+            edge_functions.append(function)
+            edge_targets.append(target_id)
+
+
+    def finish(self):
+        """Bucket the call edges by function keeping their order."""
+
+        num_functions = len(self.function_ids)
+        counts = [0] * num_functions
+        for function in self.edge_functions:
+            counts[function] += 1
+        offsets = [0] * (num_functions + 1)
+        for function in range(num_functions):
+            offsets[function + 1] = offsets[function] + counts[function]
+        self.call_offsets = array.array("l", offsets)
+
+        # Edges are usually already grouped by function since each
+        # function is defined in one place
+        edge_functions = self.edge_functions
+        if all(edge_functions[edge] <= edge_functions[edge + 1]
+                for edge in xrange(len(edge_functions) - 1)):
+            self.call_targets = self.edge_targets
         else:
-            output += "%s\n" % (self.name)
-        for call in self.calls:
-            output += "  %s\n" % (call)
-        return output
+            positions = offsets[:num_functions]
+            call_targets = [0] * len(self.edge_targets)
+            for (function, target) in zip(edge_functions, self.edge_targets):
+                call_targets[positions[function]] = target
+                positions[function] += 1
+            self.call_targets = array.array("l", call_targets)
+
+        self.name_ids = None
+        self.function_index = None
+        self.edge_functions = None
+        self.edge_targets = None
+
+
+    def get_name(self, function):
+        return self.names[self.function_ids[function]]
+
+
+    def get_calls(self, function):
+        """Return the names of the targets called by function."""
+        names = self.names
+        return [names[target] for target in self.call_targets[
+            self.call_offsets[function]:self.call_offsets[function + 1]]]
 
 
 class ProgramFunctionCalls:
     """Record function call information.
 
-    This class builds the self.functions hash to store all functions
-    that it knows about.  Each entry is an instance of FunctionCalls,
-    recording the set of targets called by a particular function.
+    Calls are kept in one CallGraph per source file.  The
+    self.functions hash maps the name of each known function to the
+    (graph, function) locations of that function within the graphs.
     """
 
-    def __init__(self, in_file):
-        """Create an empty listing."""
-        self.called_by = None
-        self.functions = {}
-        self._load_from_file(in_file)
+    # Approximate number of bytes read from the raw call file at a time
+    READ_SIZE = 1 << 20
 
+    def __init__(self, in_file, cache_file=None):
+        """Create a listing from in_file.
 
-    def _reset_called_by(self):
-        """Invalidate the reverse lookup table.
-
-        This should be called whenever the functions hash is changed.
+        If cache_file is given it is used to avoid parsing the calls of
+        source files that did not change since the last run.  See
+        _load_from_file.
         """
         self.called_by = None
+        self.graphs = {}
+        self.functions = {}
+        self._load_from_file(in_file, cache_file)
 
 
-    def add_function(self, fname, is_inline, file):
-        """Add fname to functions.
-
-        Add fname if nothing is known about it.
-        """
-        self._reset_called_by()
-        if fname not in self.functions:
-            self.functions[fname] = FunctionCalls(fname, is_inline, file)
-        assert self.functions[fname].is_inline == is_inline
-        assert self.functions[fname].file == file
+    def get_calls(self, fname):
+        """Return the names of the targets called by fname in order."""
+        calls = []
+        for (graph, function) in self.functions[fname]:
+            calls.extend(graph.get_calls(function))
+        return calls
 
 
-    def add_call(self, from_function, to_function, is_inline, file):
-        """Add call from caller from_function to target to_function.
+    def is_inline(self, fname):
+        (graph, function) = self.functions[fname][0]
+        return bool(graph.function_inline[function])
 
-        The from_function is added to the set of functions tracked by
-        this class if it is not already tracked.  The to_function is NOT
-        added to the set of functions tracked by this class.
-        """
 
-        self._reset_called_by()
-        self.add_function(from_function, is_inline, file)
-        self.functions[from_function].makes_call(to_function)
+    def get_file(self, fname):
+        """Return the file of the first line naming fname as a caller."""
+        return self.functions[fname][0][0].file
 
 
     def get_entry_points(self, roi):
@@ -103,33 +184,46 @@ class ProgramFunctionCalls:
         if self.called_by == None:
             self._build_called_by()
 
-        # Find set of entry points into ROI
+        # Find set of entry points into ROI.  A target is an entry point
+        # if any of its callers is not in the ROI.
+        roi_set = set(roi)
         entry_points = []
+        entry_set = set()
         for target in roi:
-            for caller in self.called_by[target]:
-                # If caller is not in ROI then the target is an entry
-                # point.  Add target to entry_points if it is not yet
-                # accounted for.
-                if caller not in roi and target not in entry_points:
+            if target in entry_set:
+                continue
+            for caller in self.called_by.get(target, ()):
+                if caller not in roi_set:
                     entry_points.append(target)
+                    entry_set.add(target)
+                    break
         return entry_points
 
 
     def get_roi_functions(self, roi_prefixes):
         """Get functions in an ROI.
 
-        Returns any function matching any of the specified roi_prefixes.
+        Returns the set of functions matching any of the specified
+        roi_prefixes.  The prefixes are combined into a single regular
+        expression so each function is only matched once.  If
+        roi_prefixes is None then every function is in the ROI, and if
+        it is empty then no function is.
         """
-        roi = []
-        for prefix in roi_prefixes:
-            prefixRe = re.compile(prefix)
-            for caller in self.functions.keys():
-                if prefixRe.match(caller) != None and caller not in roi:
-                    roi.append(caller)
+        if roi_prefixes == None:
+            return set(self.functions.keys())
+        if not roi_prefixes:
+            return set()
+
+        prefixRe = re.compile("|".join(["(?:%s)" % prefix
+            for prefix in roi_prefixes]))
+        roi = set()
+        for caller in self.functions.keys():
+            if prefixRe.match(caller) != None:
+                roi.add(caller)
         return roi
 
 
-    def _load_from_file(self, in_file):
+    def _load_from_file(self, in_file, cache_file=None):
         """Load data from in_file into this class instance.
 
         The format of in_file is one entry per line with each line
@@ -138,42 +232,182 @@ class ProgramFunctionCalls:
         If the target name is the special token "__DECLARATION__" then
         the caller is simply added to the set of tracked functions.
         Else it is recorded that the caller makes a call to the target.
+
+        The lines of each caller_file are read into their own CallGraph
+        in a single streaming pass.  If cache_file is given then the
+        graphs are saved there along with a hash of the lines of each
+        caller_file.  Later runs first hash in_file and then only parse
+        the lines of files whose hash changed.
         """
-        self._reset_called_by()
-        fid = open(in_file, "r")
-        for line in fid:
-            (inline_str, caller_file, caller, target) = line.split()
-            is_inline = (inline_str == "true" or
-                    inline_str == "True" or
-                    inline_str == "TRUE")
-            if target == "__DECLARATION__":
-                self.add_function(caller, is_inline, file)
+        self.called_by = None
+
+        if cache_file:
+            (file_order, digests) = self._hash_files(in_file)
+            cached_graphs = self._read_cache(cache_file)
+            changed = set([caller_file for caller_file in file_order
+                if cached_graphs.get(caller_file, (None,))[0] !=
+                digests[caller_file]])
+            if changed:
+                (ignore, graphs) = self._read_graphs(in_file, changed)
             else:
-                self.add_call(caller, target, is_inline, file)
-        fid.close()
+                graphs = {}
+            for caller_file in file_order:
+                if caller_file not in changed:
+                    graphs[caller_file] = cached_graphs[caller_file][1]
+            self._write_cache(cache_file, dict([(caller_file,
+                (digests[caller_file], graphs[caller_file]))
+                for caller_file in file_order]))
+        else:
+            (file_order, graphs) = self._read_graphs(in_file, None)
+
+        # Index the functions in the order their files first appear
+        self.graphs = graphs
+        self.functions = {}
+        for caller_file in file_order:
+            graph = graphs[caller_file]
+            for function in range(len(graph.function_ids)):
+                entries = self.functions.setdefault(
+                        graph.get_name(function), [])
+                if entries:
+                    (first_graph, first_function) = entries[0]
+                    assert first_graph.function_inline[first_function] == \
+                            graph.function_inline[function]
+                entries.append((graph, function))
+
+
+    def _read_chunks(self, in_file):
+        """Generate lists of lines of in_file read READ_SIZE at a time."""
+        fid = open(in_file, "r")
+        try:
+            while True:
+                lines = fid.readlines(self.READ_SIZE)
+                if not lines:
+                    break
+                yield lines
+        finally:
+            fid.close()
+
+
+    def _hash_files(self, in_file):
+        """Return the caller files of in_file in order of first use and
+        a hash of the lines of each."""
+        file_order = []
+        hashes = {}
+        for lines in self._read_chunks(in_file):
+            for line in lines:
+                caller_file = line.split(None, 2)[1]
+                file_hash = hashes.get(caller_file)
+                if file_hash == None:
+                    file_hash = hashes[caller_file] = hashlib.sha1()
+                    file_order.append(caller_file)
+                file_hash.update(line)
+        digests = dict([(caller_file, hashes[caller_file].hexdigest())
+            for caller_file in file_order])
+        return (file_order, digests)
+
+
+    def _read_graphs(self, in_file, caller_files):
+        """Read a CallGraph for each caller file of in_file.
+
+        Only the lines of files in caller_files are read, or of every
+        file if caller_files is None.  Returns the files read in order
+        of first use and their graphs keyed by file.
+        """
+        file_order = []
+        graphs = {}
+        for lines in self._read_chunks(in_file):
+
+            # Split the chunk by caller file and add each part in bulk
+            file_lines = {}
+            for line in lines:
+                fields = line.split()
+                caller_file = fields[1]
+                batch = file_lines.get(caller_file)
+                if batch == None:
+                    if caller_files != None and \
+                            caller_file not in caller_files:
+                        continue
+                    batch = file_lines[caller_file] = []
+                    if caller_file not in graphs:
+                        graphs[caller_file] = CallGraph(caller_file)
+                        file_order.append(caller_file)
+                batch.append(fields)
+
+            for (caller_file, batch) in file_lines.items():
+                graphs[caller_file].add_lines(batch)
+
+        for graph in graphs.values():
+            graph.finish()
+        return (file_order, graphs)
+
+
+    def _read_cache(self, cache_file):
+        """Return the (digest, CallGraph) pairs in cache_file by file.
+
+        A missing, stale, or corrupt cache is treated as empty.
+        """
+        cached_graphs = sideFile.load_pickle(cache_file, CACHE_VERSION)
+        if cached_graphs == None:
+            return {}
+        return cached_graphs
+
+
+    def _write_cache(self, cache_file, cached_graphs):
+        """Save cached_graphs to cache_file.  Failure is not an error."""
+        sideFile.save_pickle(cache_file, CACHE_VERSION, cached_graphs)
 
 
     def _build_called_by(self):
         """Generate a table containing called by data.
 
         For function f this hash stores the set of functions known (from
-        the data stored in self.functions) to call f.
+        the data stored in self.graphs) to call f.
         """
         self.called_by = {}
         for target in self.functions.keys():
             self.called_by[target] = []
-            for caller in self.functions.keys():
-                if target in self.functions[caller].calls:
-                    self.called_by[target].append(caller)
+
+        # Single pass over every call edge
+        for caller in self.functions.keys():
+            for target in self.get_calls(caller):
+                self.called_by.setdefault(target, []).append(caller)
 
 
     def __str__(self):
         """Print what each function calls."""
 
-        output = ""
-        for function in self.functions.values():
-            output += str(function)
-        return output
+        output = []
+        for fname in self.functions.keys():
+            if self.is_inline(fname):
+                output.append("%s (inline):\n" % (fname))
+            else:
+                output.append("%s\n" % (fname))
+            for call in self.get_calls(fname):
+                output.append("  %s\n" % (call))
+        return "".join(output)
+
+
+def write_if_changed(out_file, text):
+    """Write text to out_file unless out_file already holds text.
+
+    Leaving an unchanged file alone keeps its modification time, so
+    build tools do not rebuild anything that depends on it.  Returns
+    True if out_file was written.
+    """
+    try:
+        fid = open(out_file, "r")
+        try:
+            if fid.read() == text:
+                return False
+        finally:
+            fid.close()
+    except IOError:
+        pass
+
+    fid = open(out_file, "w")
+    fid.write(text)
+    fid.close()
+    return True
 
 
 def usage():
@@ -220,6 +454,16 @@ def usage():
             Define the name of the entry point into the program.  The
             default value is 'main'.
 
+    -c, --cache=cache_file
+            Save the parsed calls in cache_file along with a hash of the
+            calls from each source file.  Later runs only parse the
+            calls of source files that changed.  The cache is a side
+            file that may be deleted at any time.
+
+    -o, --output=out_file
+            Write the output to out_file rather than standard out.  The
+            file is only rewritten if its contents change.
+
     -h, --help
             Print this help information.
     """
@@ -233,9 +477,12 @@ if __name__ == '__main__':
     action = "lis"
     roi_prefix_file = None
     main = "main"
+    cache_file = None
+    out_file = None
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hr:eblkgm:",
-                ["help", "roi=", "entry", "body", "lis", "kis", "gid", "main"])
+        opts, args = getopt.getopt(sys.argv[1:], "hr:eblkgm:c:o:",
+                ["help", "roi=", "entry", "body", "lis", "kis", "gid", "main=",
+                    "cache=", "output="])
     except getopt.GetoptError, err:
         sys.stderr.write(err.msg)
         usage()
@@ -252,12 +499,16 @@ if __name__ == '__main__':
             action = "body"
         elif o in ("-l", "--lis"):
             action = "lis"
-        elif o in ("-l", "--kis"):
+        elif o in ("-k", "--kis"):
             action = "kis"
         elif o in ("-g", "--gid"):
             action = "gid"
         elif o in ("-m", "--main"):
             main = a
+        elif o in ("-c", "--cache"):
+            cache_file = a
+        elif o in ("-o", "--output"):
+            out_file = a
         else:
             assert False, "Unhandled option: " + o
     if len(args) != 1:
@@ -267,7 +518,7 @@ if __name__ == '__main__':
     rawCallsFile = args[0]
 
     # Create table
-    call_data = ProgramFunctionCalls(rawCallsFile)
+    call_data = ProgramFunctionCalls(rawCallsFile, cache_file)
 
     # Generate list of functions in ROI
     if roi_prefix_file:
@@ -280,56 +531,69 @@ if __name__ == '__main__':
     else:
         roi_prefixes = None
 
-    # Calcualet the ROI, entry functions, and body functions
-    roi = call_data.get_roi_functions(roi_prefixes)
+    # Calcualet the ROI, entry functions, and body functions.  The ROI
+    # is sorted so that output is in a stable order.
+    roi = sorted(call_data.get_roi_functions(roi_prefixes))
     entry_functions = call_data.get_entry_points(roi)
     if main in roi and main not in entry_functions:
         entry_functions.append(main)
 
+    # Sets for membership tests while writing the output
+    roi_set = set(roi)
+    entry_set = set(entry_functions)
+
     # Do stuff!
+    output = []
     if action == "body":
         for body_function in roi:
-            for target in call_data.functions[body_function].calls:
-                if target not in entry_functions:
-                    print body_function, target
+            for target in call_data.get_calls(body_function):
+                if target not in entry_set:
+                    output.append("%s %s" % (body_function, target))
 
     elif action == "entry":
         for entry_function in entry_functions:
-            print entry_function
+            output.append(entry_function)
 
     elif action == "lis":
         # Trace entry points
         for entry_function in entry_functions:
-            print "header %s global" % entry_function
+            output.append("header %s global" % entry_function)
         # Trace local calls to non-entry functions
         for body_function in roi:
-            for target in call_data.functions[body_function].calls:
-                if target not in entry_functions:
-                    print "call %s local %s" % (body_function, target)
+            for target in call_data.get_calls(body_function):
+                if target not in entry_set:
+                    output.append("call %s local %s" % (body_function, target))
         # Trace returns
         for function in roi:
-            print "footer %s point" % function
+            output.append("footer %s point" % function)
 
     elif action == "kis":
         # Trace entry points
         for entry_function in entry_functions:
-            print "header %s global" % entry_function
+            output.append("header %s global" % entry_function)
         # Trace local calls to non-entry functions
         for body_function in roi:
-            for target in call_data.functions[body_function].calls:
-                if target not in entry_functions and target in roi:
-                    print "call %s local %s" % (body_function, target)
+            for target in call_data.get_calls(body_function):
+                if target not in entry_set and target in roi_set:
+                    output.append("call %s local %s" % (body_function, target))
         # Trace returns
         for function in roi:
-            print "footer %s point" % function
+            output.append("footer %s point" % function)
 
     elif action == "gid":
         # Trace returns
         for function in roi:
-            print "header %s global" % function
-            print "footer %s point" % function
+            output.append("header %s global" % function)
+            output.append("footer %s point" % function)
 
     else:
         print "Please specify -e, -b, or -l action option."
         usage()
         sys.exit(2)
+
+    # Only rewrite out_file if the output changed
+    output_text = "".join([line + "\n" for line in output])
+    if out_file:
+        write_if_changed(out_file, output_text)
+    else:
+        sys.stdout.write(output_text)
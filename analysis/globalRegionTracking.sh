@@ -16,6 +16,6 @@ cd $DIR
 $LL/analysis/$TARGET-extractcalls $FILE.i > raw_calls.txt
 
 # Create LIS from ROI specification
-$LL/analysis/calldata.py -r roi.txt -g raw_calls.txt > $FILE.lis
+$LL/analysis/calldata.py -r roi.txt -g -c raw_calls.cache -o $FILE.lis raw_calls.txt
 
 cd $FROM_DIR
@@ -15,5 +15,5 @@ ROI_FILE=$5
 $LL/extractCalls/$TARGET-extractcalls $IN_FILE > $CALL_FILE
 
 # Create LIS from ROI specification
-$LL/calldata.py -r $ROI_FILE -l $CALL_FILE > $LIS_FILE
+$LL/calldata.py -r $ROI_FILE -l -c $CALL_FILE.cache -o $LIS_FILE $CALL_FILE
 
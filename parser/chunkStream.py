@@ -35,6 +35,10 @@
 
 # Author: Roy Shea
 
+import bisect
+
+import packet
+
 class DataMissing(Exception):
     def __init__(self, value):
         self.value = value
@@ -53,20 +57,31 @@ class ChunkStream:
     """Present a stream of data as blocks of contiguous data payloads.
 
     Separate items in the list represent data separated by one or more
-    missing packets.
+    missing packets.  Each chunk is stored as a packed bytearray with
+    the first bit of the chunk in the most significant bit of the first
+    byte.  The number of valid bits in each chunk is tracked separately
+    in chunk_lengths.
     """
 
-    def __init__(self, packets, start_time=0):
+    def __init__(self, packets, start_time=0, bit_base=0):
+        """Build the chunks of packets.
+
+        If packets are the tail of a longer chunk then bit_base is the
+        number of bits of that chunk before the first packet.  It is
+        only used for the offsets read_time reports without timestamps.
+        """
 
         self.start_time = start_time
+        self.bit_base = bit_base
 
-        # List of tripplets:
-        #    (chunk, offset, time)
-        # that describes that time occurres starting at offset within
-        # chink.
-        self.times = []
+        # Per-chunk index of packet timestamps.  For chunk c the sorted
+        # list time_offsets[c] holds the bit offset at which each packet
+        # starts and time_stamps[c] holds the matching packet time.
+        self.time_offsets = []
+        self.time_stamps = []
 
         self.chunks = []
+        self.chunk_lengths = []
         self._read_chunks(packets)
 
         self.chunk_index = 0
@@ -74,18 +89,40 @@ class ChunkStream:
 
 
     def _read_chunks(self, packets):
-        current_chunk = ""
+        # Unpack the payload bits of every packet in a single batch
+        packet.BitlogPacket.unpack_payloads([p for p in packets if p])
+
+        current_chunk = bytearray()
         tmp_chunk_offset = 0
         tmp_bit_offset = 0
 
+        # Bits not yet packed into a full byte of current_chunk
+        pending = 0
+        pending_bits = 0
+
         for p in packets:
             if p:
-                current_chunk += p.bit_string()
-                self.times.append((tmp_chunk_offset, tmp_bit_offset, p.timestamp))
-                tmp_bit_offset += len(p.bit_string())
-            elif len(current_chunk) > 0:
-                self.chunks.append(current_chunk)
-                current_chunk = ""
+                (value, num_bits) = p.bit_value()
+                if len(self.time_offsets) == tmp_chunk_offset:
+                    self.time_offsets.append([])
+                    self.time_stamps.append([])
+                self.time_offsets[tmp_chunk_offset].append(tmp_bit_offset)
+                self.time_stamps[tmp_chunk_offset].append(p.timestamp)
+                tmp_bit_offset += num_bits
+
+                pending = (pending << num_bits) | value
+                pending_bits += num_bits
+                while pending_bits >= 8:
+                    pending_bits -= 8
+                    current_chunk.append((pending >> pending_bits) & 0xFF)
+                pending &= (1 << pending_bits) - 1
+
+            elif tmp_bit_offset > 0:
+                self._add_chunk(current_chunk, tmp_bit_offset,
+                        pending, pending_bits)
+                current_chunk = bytearray()
+                pending = 0
+                pending_bits = 0
                 tmp_chunk_offset += 1
                 tmp_bit_offset = 0
             else:
@@ -94,19 +131,42 @@ class ChunkStream:
                 assert False
 
         # Write the last packet as a chunk
-        if len(current_chunk) > 0:
-            self.chunks.append(current_chunk)
+        if tmp_bit_offset > 0:
+            self._add_chunk(current_chunk, tmp_bit_offset,
+                    pending, pending_bits)
+        return
+
+
+    def _add_chunk(self, chunk, length, pending, pending_bits):
+        """Flush any trailing partial byte into chunk and store it."""
+
+        if pending_bits > 0:
+            chunk.append((pending << (8 - pending_bits)) & 0xFF)
+        self.chunks.append(chunk)
+        self.chunk_lengths.append(length)
         return
 
 
     def peek_bytes(self, length):
+        """Return the next length bits of the current chunk as an integer.
 
-        current_chunk = self.chunks[self.chunk_index]
+        The first bit in the stream is the most significant bit of the
+        returned value.
+        """
 
-        if len(current_chunk) >= self.bit_index + length:
+        if self.chunk_lengths[self.chunk_index] >= self.bit_index + length:
             # Normal operation
-            bytes = ''.join(current_chunk[self.bit_index:self.bit_index+length])
-            assert len(bytes) == length
+            if length == 0:
+                return 0
+            current_chunk = self.chunks[self.chunk_index]
+            end_index = self.bit_index + length
+            start_byte = self.bit_index >> 3
+            end_byte = (end_index + 7) >> 3
+            bytes = 0
+            for byte in current_chunk[start_byte:end_byte]:
+                bytes = (bytes << 8) | byte
+            bytes >>= (end_byte << 3) - end_index
+            bytes &= (1 << length) - 1
 
         elif self.chunk_index < len(self.chunks) - 1:
             # Request can't be satisfied in the current chunk, but there
@@ -134,19 +194,51 @@ class ChunkStream:
         return bytes
 
 
+    def skip_bytes(self, length):
+        """Advance past length bits already known to be in the chunk."""
+        self.bit_index += length
+
+
     def read_time(self):
-        chunk_times = [t for t in self.times if \
-                t[0] == self.chunk_index and t[1] <= self.bit_index]
-        time = chunk_times[-1][2]
-        start_bit = chunk_times[-1][1]
+        """Return (time, bit_offset) of the current position.
+
+        The time is that of the packet containing the current bit and
+        bit_offset is the position of the current bit within that packet.
+        """
+
+        offsets = self.time_offsets[self.chunk_index]
+        packet_index = bisect.bisect_right(offsets, self.bit_index) - 1
+        time = self.time_stamps[self.chunk_index][packet_index]
+        start_bit = offsets[packet_index]
 
         if not self.start_time:
             assert not time
+            if self.chunk_index == 0:
+                return (0, self.bit_base + self.bit_index)
             return (0, self.bit_index)
 
         return (time - self.start_time, self.bit_index - start_bit)
 
 
+def split_trace(trace):
+    """Generate the lists of packets making up each chunk of a trace.
+
+    Chunks within trace are separated by None entries that mark missing
+    packets.  Each chunk can be parsed independently of the others.
+    The trace is read lazily, so only the current chunk is held in
+    memory.
+    """
+
+    current_chunk = []
+    for p in trace:
+        if p:
+            current_chunk.append(p)
+        elif current_chunk:
+            yield current_chunk
+            current_chunk = []
+    if current_chunk:
+        yield current_chunk
+
 
 if __name__ == '__main__':
     assert False, "Stick a fork in it 'cause you're done."
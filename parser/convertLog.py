@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009, Regents of the University of California
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# * Neither the name of the University of California, Los Angeles
+# nor the names of its contributors may be used to endorse or
+# promote products derived from this software without specific prior
+# written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Author: Roy Shea
+
+from optparse import OptionParser
+import sys
+import packet
+
+
+def main():
+
+    # Handle the command line
+    usage = "usage: %prog [options] trace capture"
+    parser = OptionParser(usage)
+
+    parser.add_option("-m", "--mode", dest="mode", metavar="STRING",
+            default="system", help="Specify the trace mode of the " +
+            "input trace that may be network or system [default: %default]")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Must specify both the trace and capture file names")
+    (trace_file, capture_file) = args
+
+    if options.mode not in packet.TRACE_MODES or options.mode == "binary":
+        parser.error("option -m must be either network or system")
+
+    # Convert the Bitlog packets of the trace.  Other packets from the
+    # listener are dropped.
+    packets = packet.read_trace(trace_file, options.mode)
+    try:
+        capture = open(capture_file, "wb")
+    except IOError, e:
+        parser.error("can not write %s: %s" % (capture_file, e.strerror))
+    try:
+        count = packet.write_binary_packets(packets, capture)
+    finally:
+        capture.close()
+
+    sys.stderr.write("Wrote %d bitlog packets to %s\n" % (count, capture_file))
+
+
+if __name__ == '__main__':
+    main()
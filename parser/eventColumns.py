@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Regents of the University of California
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# * Neither the name of the University of California, Los Angeles
+# nor the names of its contributors may be used to endorse or
+# promote products derived from this software without specific prior
+# written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Author: Roy Shea
+
+import array
+
+import rlisTokens
+
+# NumPy is optional.  Without it events are still stored in compact
+# arrays, but to_numpy is unavailable.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class EventColumns:
+    """Columnar store of decoded events from one or more node traces.
+
+    Rather than a list of (token, (time, bit_offset)) tuples, each field
+    of the decoded events is kept in its own parallel array:
+    - kind: RlisEntry type of the token, or CHUNK_END for the marker
+      separating chunks
+    - token: index of the token in self.tokens, or -1 for CHUNK_END
+    - node: identifier of the node that logged the event
+    - time: time of the packet containing the event
+    - bit_offset: offset of the event within its packet
+    - depth: call depth at which the event occurred
+    - value: logged value for watch events and 0 for all others
+
+    The value column is kept in a list instead of an array once a watch
+    value is too wide for the array type.
+    """
+
+    CHUNK_END = 0
+
+    COLUMNS = ("kind", "token", "node", "time", "bit_offset", "depth",
+            "value")
+
+    # Array type codes used for each column
+    TYPE_CODES = {"kind": "b", "token": "l", "node": "l", "time": "d",
+            "bit_offset": "l", "depth": "l", "value": "l"}
+
+    def __init__(self, token_table):
+
+        self.token_table = token_table
+
+        # Distinct tokens referenced by the token column
+        self.tokens = []
+        self.token_indexes = {}
+
+        # (node_id, start, end) range of the events of each added trace
+        self.trace_ranges = []
+
+        for name in self.COLUMNS:
+            setattr(self, name, array.array(self.TYPE_CODES[name]))
+
+
+    def _token_index(self, token):
+        """Return the index of token in self.tokens, adding it if needed."""
+
+        # Tokens returned by pool workers are copies, so index tokens by
+        # their identifying fields rather than by object identity.
+        key = (token.type, token.scope, token.function_name, token.id)
+        index = self.token_indexes.get(key)
+        if index == None:
+            index = len(self.tokens)
+            self.tokens.append(token)
+            self.token_indexes[key] = index
+        return index
+
+
+    def add_trace(self, node_id, tokens_and_times):
+        """Append the events returned by RoiParser.tokenize_trace.
+
+        The tokens_and_times may be any iterable, such as the generator
+        returned by RoiParser.generate_tokens, and is consumed once.
+        """
+
+        start = len(self)
+        call_depth = 0
+        for (token, time_and_offset) in tokens_and_times:
+
+            if not token:
+                self._append(self.CHUNK_END, -1, node_id, float("nan"),
+                        0, 0, 0)
+                call_depth = 0
+                continue
+
+            value = 0
+            if isinstance(token, rlisTokens.WatchEvent):
+                value = token.data
+                token = token.token
+
+            self._append(token.type, self._token_index(token), node_id,
+                    time_and_offset[0], time_and_offset[1], call_depth,
+                    value)
+
+            # Track call depth the same way RoiParser._print_tokens does
+            if token.type == rlisTokens.RlisEntry.FOOTER:
+                call_depth -= 1
+            elif token.type == rlisTokens.RlisEntry.HEADER:
+                call_depth += 1
+            elif token.type == rlisTokens.RlisEntry.CALL and \
+                    self.token_table.has_point_footer(token.target):
+                call_depth += 1
+
+        self.trace_ranges.append((node_id, start, len(self)))
+        return
+
+
+    def trace_ids(self):
+        """Return the sorted identifiers of the nodes with events."""
+        return sorted(set([node_id for (node_id, start, end) in
+            self.trace_ranges]))
+
+
+    def trace_tokens(self, node_id):
+        """Generate the tokens of node_id in the order they were added.
+
+        Watch events are returned as WatchEvent objects and the end of a
+        chunk as None, matching the tokens of RoiParser.tokenize_trace.
+        """
+
+        for (range_id, start, end) in self.trace_ranges:
+            if range_id != node_id:
+                continue
+            for index in xrange(start, end):
+                if self.kind[index] == self.CHUNK_END:
+                    yield None
+                    continue
+                token = self.tokens[self.token[index]]
+                if token.type == rlisTokens.RlisEntry.WATCH:
+                    token = rlisTokens.WatchEvent(token, self.value[index])
+                yield token
+
+
+    def _append(self, kind, token, node, time, bit_offset, depth, value):
+        self.kind.append(kind)
+        self.token.append(token)
+        self.node.append(node)
+        self.time.append(time)
+        self.bit_offset.append(bit_offset)
+        self.depth.append(depth)
+        try:
+            self.value.append(value)
+        except OverflowError:
+            # Watch values wider than the array type are kept in a list
+            self.value = list(self.value)
+            self.value.append(value)
+
+
+    def __len__(self):
+        return len(self.kind)
+
+
+    def to_numpy(self):
+        """Return a dictionary of NumPy arrays, one for each column.
+
+        The arrays share memory with the columns rather than copying
+        them, so they are only valid until more events are added.  A
+        value column holding wide values is copied to an array of
+        Python objects.
+        """
+
+        if numpy == None:
+            raise ImportError("NumPy is required for EventColumns.to_numpy")
+
+        columns = {}
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if isinstance(column, list):
+                columns[name] = numpy.array(column, dtype=object)
+                continue
+            dtype = numpy.dtype(column.typecode)
+            if len(column) == 0:
+                columns[name] = numpy.zeros(0, dtype)
+            else:
+                columns[name] = numpy.frombuffer(column, dtype)
+        return columns
+
+
+if __name__ == '__main__':
+    assert False, "Stick a fork in it 'cause you're done."
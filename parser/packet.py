@@ -35,6 +35,51 @@
 
 # Author: Roy Shea
 
+import sys
+import binascii
+import mmap
+import struct
+
+class PacketFormatError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def parse_hex_line(packet_string):
+    """Parse a line of space separated hex bytes.
+
+    Output may have an optional timestamp.  This can be detected by
+    looking for a decmial in the first space separated field.  Returns
+    the tuple (timestamp, data) where timestamp is None if not present
+    and data is a bytearray.  Raises PacketFormatError if the line is
+    not valid.
+    """
+
+    fields = packet_string.split(None, 1)
+    if not fields:
+        raise PacketFormatError("Empty line")
+
+    timestamp = None
+    hex_data = packet_string
+    if "." in fields[0]:
+        try:
+            timestamp = float(fields[0])
+        except ValueError:
+            raise PacketFormatError("Invalid timestamp: %s" % fields[0])
+        if len(fields) > 1:
+            hex_data = fields[1]
+        else:
+            hex_data = ""
+
+    try:
+        data = bytearray.fromhex(hex_data.strip())
+    except ValueError:
+        raise PacketFormatError("Invalid hex data: %s" % hex_data.strip())
+    return (timestamp, data)
+
+
 class Packet:
     """Core packet representation"""
 
@@ -74,17 +119,11 @@ class AMPacket (Packet):
     def __init__(self, packet_string):
         """Parse space separated hex string from a TinyOS AM Packet."""
 
-        # Output may have an optional timestamp.  This can be detected
-        # by looking for a decmial in the first space separated field.
-        fields = packet_string.split()
-        if "." in fields[0]:
-            timestamp = float(fields[0])
-            fields = fields[1:]
-        else:
-            timestamp = None
+        (timestamp, data) = parse_hex_line(packet_string)
 
         # Parse the AM packet
-        data = [int(x, 16) for x in fields]
+        if len(data) < 8:
+            raise PacketFormatError("AM packet too short: %d bytes" % len(data))
         zero = data[0]
         dst_addr = data[1] * 256 + data[2]
         src_addr = data[3] * 256 + data[4]
@@ -94,8 +133,10 @@ class AMPacket (Packet):
         payload = data[8:]
 
         # Verify the validity of the packet
-        assert zero == 0, "Zero byte must be zero"
-        assert msg_len == len(payload), "Incorrect payload length"
+        if zero != 0:
+            raise PacketFormatError("Zero byte must be zero")
+        if msg_len != len(payload):
+            raise PacketFormatError("Incorrect payload length")
 
         # Create the core packet.  The TinyOS handler_id is equivalent
         # to a port.
@@ -111,16 +152,8 @@ class SystemPacket (Packet):
     def __init__(self, packet_string):
         """Parse space separated hex string from a libbitlog system packet."""
 
-        # Output may have an optional timestamp.  This can be detected
-        # by looking for a decmial in the first space separated field.
-        fields = packet_string.split()
-        if "." in fields[0]:
-            timestamp = float(fields[0])
-            fields = fields[1:]
-        else:
-            timestamp = None
+        (timestamp, data) = parse_hex_line(packet_string)
 
-        data = [int(x, 16) for x in fields]
         src_addr = self.DUMMY_ADDR
         dst_addr = self.DUMMY_ADDR
         # TODO: Beware ugly hardcoded port :-/
@@ -149,6 +182,9 @@ class BitlogPacket (Packet):
         self.seq_num = packet.payload[1]
         src_addr = packet.payload[3] * 256 + packet.payload[2]
 
+        # Cached (value, num_bits) of the payload bits.  See bit_value.
+        self.bits = None
+
         # Fill in base fields
         Packet.__init__(self, packet.dst_addr, src_addr, packet.port,
                 packet.payload[4:], packet.timestamp)
@@ -157,13 +193,34 @@ class BitlogPacket (Packet):
     def bit_string(self):
         """Return binary representation of hex string payload."""
 
-        bit_str = ""
-        for byte in self.payload:
-            assert 2**8 > byte and byte >= 0, \
-                    "Invalid 8-bit hex value: %s\n" % byte
-            bits = "".join([str((byte >> y) & 1) for y in range(8-1, -1, -1)])
-            bit_str += bits
-        return bit_str[:self.num_bits]
+        (value, num_bits) = self.bit_value()
+        if num_bits == 0:
+            return ""
+        return format(value, "0%db" % num_bits)
+
+
+    def bit_value(self):
+        """Return (value, num_bits) packing the payload bits into an integer.
+
+        The first logged bit is the most significant bit of value.  The
+        result is cached on the packet.
+        """
+
+        if self.bits == None:
+            self.bits = self._bits_of_hex(
+                    binascii.hexlify(bytearray(self.payload)))
+        return self.bits
+
+
+    def _bits_of_hex(self, hex_payload):
+        """Return (value, num_bits) for the hex encoding of the payload."""
+
+        payload_bits = 4 * len(hex_payload)
+        num_bits = min(self.num_bits, payload_bits)
+        if num_bits == 0:
+            return (0, 0)
+        value = int(hex_payload, 16) >> (payload_bits - num_bits)
+        return (value, num_bits)
 
 
     def __str__(self):
@@ -185,21 +242,69 @@ class BitlogPacket (Packet):
                 packet.msg_len == self.BITLOG_LENGTH
 
 
+    @classmethod
+    def unpack_payloads(self, packets):
+        """Cache the bit_value of many bitlog packets at once.
+
+        The payloads of all packets not yet unpacked are copied into a
+        single contiguous buffer that is hex encoded in one pass.  Each
+        packet then only converts its slice of the encoded buffer.
+        """
+
+        pending = [p for p in packets if p.bits == None]
+        if not pending:
+            return
+
+        buffer = bytearray()
+        for p in pending:
+            buffer.extend(p.payload)
+        hex_payloads = binascii.hexlify(buffer)
+
+        offset = 0
+        for p in pending:
+            length = 2 * len(p.payload)
+            p.bits = p._bits_of_hex(hex_payloads[offset:offset + length])
+            offset += length
+        return
+
+
     @classmethod
     def get_bitlog_packets(self, packets):
-        """Return list of bitlog packets from packets."""
+        """Generate the bitlog packets found in packets.
+
+        Packets are consumed and bitlog packets yielded one at a time so
+        that packets may be any iterable, including the generator
+        returned by read_packets.
+        """
 
-        bitlog_packets = []
         for p in packets:
             if self.is_bitlog_packet(p):
-                bitlog_packets.append(BitlogPacket(p))
-        return bitlog_packets
+                yield BitlogPacket(p)
+
+
+def generate_packets(lines, packet_class):
+    """Generate a packet of type packet_class for each line in lines.
+
+    Lines that can not be parsed are reported on stderr and skipped.
+    """
+
+    line_number = 0
+    for line in lines:
+        line_number += 1
+        try:
+            packet = packet_class(line)
+        except PacketFormatError, e:
+            sys.stderr.write("Skipping line %d: %s\n" % (line_number, e.value))
+            continue
+        yield packet
 
 
 def read_packets(file, packet_class):
-    """Read packets from file."""
+    """Read packets from file.
 
-    import sys
+    Returns a generator that parses packets lazily as lines are read
+    from file, so the full trace never needs to be held in memory.
+    """
 
     # Read in packets
     try:
@@ -208,13 +313,249 @@ def read_packets(file, packet_class):
         print "Unable to open file: %s" % file
         sys.exit(1)
 
-    packets = []
-    for line in file:
-        packet = packet_class(line)
-        packets.append(packet)
-    file.close()
+    return _read_open_packets(file, packet_class)
+
+
+def _read_open_packets(file, packet_class):
+    """Generate packets from the open file and close it when done."""
+
+    try:
+        for packet in generate_packets(file, packet_class):
+            yield packet
+    finally:
+        file.close()
+
+
+def follow_lines(file, poll_interval=0.5):
+    """Generate complete lines from file as they are written to it.
+
+    This behaves similar to "tail -f".  When the end of file is reached
+    the generator sleeps for poll_interval seconds and then checks for
+    new data.  If poll_interval is None then the generator instead stops
+    at the end of file, which is the desired behavior for pipes such as
+    stdin.  Blank lines are skipped.
+    """
+
+    import time
+
+    partial = ""
+    while True:
+        line = file.readline()
+        if not line:
+            if poll_interval == None:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        # Hold on to partially written lines until they are completed
+        partial += line
+        if not partial.endswith("\n") and poll_interval != None:
+            continue
+        line = partial
+        partial = ""
+
+        if line.strip():
+            yield line
+
+    if partial.strip():
+        yield partial
+
+
+def follow_packets(file, packet_class, poll_interval=0.5):
+    """Follow packets appended to file.
+
+    The special file name "-" reads packets from stdin until it is
+    closed.  Any other file is followed until the generator is closed.
+    """
+
+    if file == "-":
+        return generate_packets(follow_lines(sys.stdin, None), packet_class)
+
+    try:
+        file = open(file)
+    except IOError:
+        print "Unable to open file: %s" % file
+        sys.exit(1)
+
+    return generate_packets(follow_lines(file, poll_interval), packet_class)
+
+
+# Binary capture format.  A binary capture begins with a file header
+# holding the BINARY_MAGIC string and the format version.  It is
+# followed by one record per packet.  Each record is a fixed header
+# holding the receive time as seconds and microseconds, the source
+# address, the port, and the length of the data that follows, after
+# which comes the raw Bitlog struct.  All values are little endian.  A
+# packet received without a timestamp is stored with seconds set to
+# BINARY_NO_TIMESTAMP.
+BINARY_MAGIC = "LISB"
+BINARY_VERSION = 2
+BINARY_FILE_HEADER = struct.Struct("<4sB3x")
+BINARY_RECORD_HEADER = struct.Struct("<IIHBB")
+BINARY_NO_TIMESTAMP = 0xFFFFFFFF
+
+
+class BinaryTrace:
+    """Memory mapped reader for a binary capture.
+
+    Iterating over a BinaryTrace generates a Packet for each record.
+    Record headers are decoded directly from the memory map, so only
+    the payload of each packet is copied out of the file.
+    """
+
+    def __init__(self, file_name):
+
+        self.file = open(file_name, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # Empty files can not be mapped
+            self.file.close()
+            raise PacketFormatError("Empty binary capture: %s" % file_name)
+
+        try:
+            if len(self.map) < BINARY_FILE_HEADER.size:
+                raise PacketFormatError("Truncated binary capture header")
+            (magic, version) = BINARY_FILE_HEADER.unpack_from(self.map, 0)
+            if magic != BINARY_MAGIC:
+                raise PacketFormatError("Not a binary capture: %s" %
+                        file_name)
+            if version != BINARY_VERSION:
+                raise PacketFormatError(
+                        "Unsupported binary capture version: %d" % version)
+        except PacketFormatError:
+            self.close()
+            raise
+
+
+    def records(self, offset=BINARY_FILE_HEADER.size):
+        """Generate (offset, timestamp, source, port, data_offset, length)
+        for each record starting at offset.
+
+        A truncated record at the end of the capture is reported on
+        stderr.
+        """
+
+        end = len(self.map)
+        header_size = BINARY_RECORD_HEADER.size
+        while offset < end:
+            if offset + header_size > end:
+                sys.stderr.write("Truncated record at byte %d\n" % offset)
+                return
+            (seconds, microseconds, source, port, length) = \
+                    BINARY_RECORD_HEADER.unpack_from(self.map, offset)
+            data_offset = offset + header_size
+            if data_offset + length > end:
+                sys.stderr.write("Truncated record at byte %d\n" % offset)
+                return
+            if seconds == BINARY_NO_TIMESTAMP:
+                timestamp = None
+            else:
+                timestamp = float("%d.%06d" % (seconds, microseconds))
+            yield (offset, timestamp, source, port, data_offset, length)
+            offset = data_offset + length
+
+
+    def packet_at(self, timestamp, source, port, data_offset, length):
+        """Return the Packet for a record returned by records."""
+
+        payload = bytearray(self.map[data_offset:data_offset + length])
+        return Packet(0, source, port, payload, timestamp)
+
+
+    def read_packet(self, offset):
+        """Return the Packet for the record starting at offset."""
+
+        for record in self.records(offset):
+            return self.packet_at(*record[1:])
+        raise PacketFormatError("No record at byte %d" % offset)
+
+
+    def __iter__(self):
+        for record in self.records():
+            yield self.packet_at(*record[1:])
+
 
-    return packets
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def read_binary_packets(file):
+    """Read packets from the binary capture file.
+
+    Returns a generator over the packets in the capture.
+    """
+
+    try:
+        trace = BinaryTrace(file)
+    except IOError:
+        print "Unable to open file: %s" % file
+        sys.exit(1)
+    except PacketFormatError, e:
+        print "Unable to read binary capture: %s" % e.value
+        sys.exit(1)
+
+    return _read_binary_trace(trace)
+
+
+def _read_binary_trace(trace):
+    """Generate packets from trace and close it when done."""
+
+    try:
+        for packet in trace:
+            yield packet
+    finally:
+        trace.close()
+
+
+# Class used to parse the lines of a trace in each trace mode.  Binary
+# captures are not line based and have no packet class.
+TRACE_MODES = {
+        "network": AMPacket,
+        "system": SystemPacket,
+        "binary": None,
+        }
+
+
+def read_trace(file, mode):
+    """Read packets from file holding a trace in one of TRACE_MODES.
+
+    Returns a generator over the packets in the trace.
+    """
+
+    if mode == "binary":
+        return read_binary_packets(file)
+    return read_packets(file, TRACE_MODES[mode])
+
+
+def write_binary_packets(packets, file):
+    """Write the packets carrying Bitlog data to the open file as a
+    binary capture.
+
+    Packets that are not Bitlog packets are skipped.  Returns the number
+    of packets written.
+    """
+
+    file.write(BINARY_FILE_HEADER.pack(BINARY_MAGIC, BINARY_VERSION))
+    count = 0
+    for packet in packets:
+        if not BitlogPacket.is_bitlog_packet(packet):
+            continue
+        if packet.timestamp == None:
+            (seconds, microseconds) = (BINARY_NO_TIMESTAMP, 0)
+        else:
+            seconds = int(packet.timestamp)
+            microseconds = int(round((packet.timestamp - seconds) * 1000000))
+            if microseconds == 1000000:
+                seconds += 1
+                microseconds = 0
+        file.write(BINARY_RECORD_HEADER.pack(seconds, microseconds,
+            packet.src_addr, packet.port, len(packet.payload)))
+        file.write(str(bytearray(packet.payload)))
+        count += 1
+    return count
 
 
 if __name__ == '__main__':
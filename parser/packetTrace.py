@@ -35,79 +35,417 @@
 
 # Author: Roy Shea
 
+import collections
+import cStringIO
+import struct
+import tempfile
+
+import packet as packet_module
+
 
 class SourceTrace:
     """Set of per-source packet traces."""
 
+    # Sequence numbers are a uint8_t on the mote and wrap from 255 to 0
     MAX_SEQ_NUM = 255
+    SEQ_NUM_MODULUS = MAX_SEQ_NUM + 1
 
-    def __init__(self, packets):
-        """Sort set of packets into per-source traces."""
+    # Packets that arrive ahead of a missing packet are held for up to
+    # this many packets, or this many seconds, before the missing packet
+    # is declared lost.
+    REORDER_WINDOW = 8
+    REORDER_TIMEOUT = 1.0
+
+    # Number of recent packets from each source checked for duplicates
+    DUPLICATE_WINDOW = 64
+
+    def __init__(self, packets=()):
+        """Sort set of packets into per-source traces.
+
+        Packets are consumed one at a time so that packets may be any
+        iterable, including a generator reading from a trace file.  The
+        full traces are kept in memory.  Use sequence instead to
+        generate the traces as packets arrive.
+        """
 
         self.traces = {}
 
-        # Sort incoming packets into per-source lists
-        sorted_packets = {}
+        # Timestamp of the first packet in the trace of each source
+        self.first_times = {}
+
+        # Last sequence number added to the trace of each source
+        self.prior_seq_nums = {}
+
+        # Packets from each source waiting on a missing sequence number,
+        # keyed by sequence number
+        self.pending = {}
+
+        # Keys of the most recent packets from each source, both as a
+        # set for lookup and in arrival order for expiring old keys
+        self.recent_keys = {}
+        self.recent_order = {}
+
+        # Number of duplicate packets dropped from each source
+        self.duplicates = {}
+
+        # Number of packets added to the trace of each source, and the
+        # sequence numbers skipped over by gaps keyed to that count
+        self.appended = {}
+        self.skipped = {}
+
+        # Number of packets from each source dropped for arriving after
+        # their place in the trace was marked missing
+        self.late = {}
+
         for packet in packets:
-            trace = sorted_packets.setdefault(packet.src_addr, [])
-            trace.append(packet)
+            self.add_packet(packet)
+        self.flush()
+
+
+    def add_packet(self, packet):
+        """Insert packet into the trace for its source.
+
+        Packets from a source may arrive out of order, as happens when
+        logs are forwarded over multiple hops.  A packet that arrives
+        ahead of its predecessor is held in a small reorder window until
+        the predecessor arrives.  The gap is only marked with None once
+        the window fills or times out.
+
+        A packet behind the trace is only dropped as late if its
+        sequence number was recently skipped over by a gap.  Any other
+        packet that can not be placed, such as one sent after a reboot
+        or a large loss, marks a gap and restarts the sequence.
+        """
+
+        source = packet.src_addr
+        trace = self.traces.setdefault(source, [])
+        pending = self.pending.setdefault(source, {})
+        prior_seq_num = self.prior_seq_nums.get(source)
+
+        if self._is_duplicate(source, packet):
+            self.duplicates[source] = self.duplicates.get(source, 0) + 1
+            return
+
+        if prior_seq_num == None:
+            self._append(source, packet)
+            return
+
+        distance = self._seq_distance(prior_seq_num, packet.seq_num)
+        if distance == 0 and self._extends(trace[-1], packet):
+            # The log was flushed before it filled and then sent again
+            # with more data, so keep the most recent packet.
+            trace[-1] = packet
+            if self.appended[source] == 1:
+                self.first_times[source] = packet.timestamp
+        elif distance == 0 and self._extends(packet, trace[-1]):
+            # An early flush of the last packet arriving after the full
+            # packet.  The trace already holds its bits.
+            self.late[source] = self.late.get(source, 0) + 1
+        elif distance == 1:
+            self._append(source, packet)
+            self._release(source)
+        elif 0 < distance < self.SEQ_NUM_MODULUS / 2:
+            pending[packet.seq_num] = packet
+            self._expire(source, packet.timestamp)
+        elif self._is_late(source, packet):
+            # Arrived after its slot was already marked missing
+            del self.skipped[source][packet.seq_num]
+            self.late[source] = self.late.get(source, 0) + 1
+        else:
+            self._restart(source, packet)
+
+    def sequence(self, packets):
+        """Generate (source, packet) pairs in the order that packets are
+        placed in the per-source traces.
+
+        A packet of None marks missing data.  Unlike the constructor,
+        only the last packet of each trace is kept in memory.  It is
+        held back until the next packet from its source is placed, since
+        until then it may still be replaced by a resent copy holding
+        more bits.
+        """
+
+        for packet in packets:
+            self.add_packet(packet)
+            for entry in self._take_placed(packet.src_addr, 1):
+                yield entry
+
+        self.flush()
+        for source in sorted(self.traces.keys()):
+            for entry in self._take_placed(source, 0):
+                yield entry
+
+
+    def _take_placed(self, source, keep):
+        """Remove all but the last keep packets from the trace of source
+        and return them as (source, packet) pairs."""
+
+        trace = self.traces[source]
+        count = len(trace) - keep
+        if count <= 0:
+            return []
+        placed = [(source, packet) for packet in trace[:count]]
+        del trace[:count]
+        return placed
+
+
+    def flush(self):
+        """Add all packets still held in reorder windows to the traces."""
+
+        for source in self.pending.keys():
+            self.flush_source(source)
+
+
+    def flush_source(self, source):
+        """Add all packets held in the reorder window of source."""
+
+        while self.pending.get(source):
+            self._skip_gap(source)
+
+
+    def _is_duplicate(self, source, packet):
+        """Check if packet repeats a recent packet from source.
+
+        Packets are keyed on their sequence number and payload.  Keys
+        older than DUPLICATE_WINDOW packets are forgotten so that the
+        check stays constant time and sequence numbers may wrap.
+        """
+
+        key = (packet.seq_num, packet.num_bits, str(bytearray(packet.payload)))
+        recent_keys = self.recent_keys.setdefault(source, set())
+        if key in recent_keys:
+            return True
+
+        recent_order = self.recent_order.setdefault(source,
+                collections.deque())
+        if len(recent_order) == self.DUPLICATE_WINDOW:
+            recent_keys.discard(recent_order.popleft())
+        recent_keys.add(key)
+        recent_order.append(key)
+        return False
+
+
+    def _seq_distance(self, prior_seq_num, seq_num):
+        """Number of packets from prior_seq_num forward to seq_num."""
+
+        return (seq_num - prior_seq_num) % self.SEQ_NUM_MODULUS
+
+
+    def _extends(self, last_packet, packet):
+        """Check if packet holds the bits of last_packet followed by more."""
+
+        (last_value, last_bits) = last_packet.bit_value()
+        (value, num_bits) = packet.bit_value()
+        return num_bits > last_bits and \
+                value >> (num_bits - last_bits) == last_value
+
+
+    def _is_late(self, source, packet):
+        """Check if packet fills a slot recently skipped over by a gap."""
+
+        skipped_at = self.skipped.get(source, {}).get(packet.seq_num)
+        return skipped_at != None and \
+                self.appended[source] - skipped_at <= self.REORDER_WINDOW
+
 
+    def _restart(self, source, packet):
+        """Mark a gap and restart the sequence of source at packet."""
 
-        # For the trace from each source...
-        for source in sorted_packets.keys():
-
-            # Create an empty trace
-            self.traces[source] = []
-            prior_seq_num = None
-
-            # Insert "None" packets to mark for each sorted trace
-            for packet in sorted_packets[source]:
-                # Insert packet into stream using None to mark missing packets.
-                if prior_seq_num == None or \
-                        (prior_seq_num + 1) % self.MAX_SEQ_NUM == packet.seq_num:
-                    self.traces[source].append(packet)
-                    prior_seq_num = packet.seq_num
-                elif (prior_seq_num) % self.MAX_SEQ_NUM == packet.seq_num:
-                    # Assume repated packet sequence number is the result of
-                    # a retransmission or similar network problem.  Simply
-                    # save the most recent packet.
-                    self.traces[source] = self.traces[source][:-1]
-                    self.traces[source].append(packet)
-                    prior_seq_num = packet.seq_num
-                else:
-                    self.traces[source].append(None)
-                    self.traces[source].append(packet)
-                    prior_seq_num = packet.seq_num
+        self.flush_source(source)
+        self.traces[source].append(None)
+        self._append(source, packet)
+
+
+    def _append(self, source, packet):
+        self.traces[source].append(packet)
+        if source not in self.first_times:
+            self.first_times[source] = packet.timestamp
+        self.prior_seq_nums[source] = packet.seq_num
+        self.appended[source] = self.appended.get(source, 0) + 1
+
+
+    def _release(self, source):
+        """Move held packets that now follow the trace into the trace."""
+
+        pending = self.pending[source]
+        while pending:
+            seq_num = (self.prior_seq_nums[source] + 1) % self.SEQ_NUM_MODULUS
+            if seq_num not in pending:
+                break
+            self._append(source, pending.pop(seq_num))
+
+
+    def _expire(self, source, timestamp):
+        """Declare gaps until the reorder window of source is in bounds."""
+
+        pending = self.pending[source]
+        while pending:
+            oldest = min(p.timestamp for p in pending.values())
+            if len(pending) <= self.REORDER_WINDOW and (timestamp == None or
+                    oldest == None or
+                    timestamp - oldest <= self.REORDER_TIMEOUT):
+                break
+            self._skip_gap(source)
+
+
+    def _skip_gap(self, source):
+        """Mark missing data and continue with the next held packet."""
+
+        pending = self.pending[source]
+        prior_seq_num = self.prior_seq_nums[source]
+        seq_num = min(pending.keys(),
+                key=lambda s: self._seq_distance(prior_seq_num, s))
+
+        # Remember the skipped sequence numbers so that their packets
+        # are recognized as late if they still arrive
+        skipped = self.skipped.setdefault(source, {})
+        for distance in range(1, self._seq_distance(prior_seq_num, seq_num)):
+            skipped[(prior_seq_num + distance) % self.SEQ_NUM_MODULUS] = \
+                    self.appended[source]
+
+        self.traces[source].append(None)
+        self._append(source, pending.pop(seq_num))
+        self._release(source)
 
 
     def get_start_time(self):
 
         min_time = None
-        for node_id in self.traces.keys():
-
-            # Ignore empty traces
-            if len(self.traces[node_id]) == 0:
-                continue
+        for node_id in self.first_times.keys():
 
             # Track the minimum start time
             if min_time:
-                min_time = min(min_time, self.traces[node_id][0].timestamp)
+                min_time = min(min_time, self.first_times[node_id])
             else:
-                min_time = self.traces[node_id][0].timestamp
+                min_time = self.first_times[node_id]
 
         return min_time
 
+    def write_dropped(self, out):
+        """Write the number of duplicate and late packets dropped from
+        each source."""
+
+        for source in sorted(self.duplicates.keys()):
+            out.write("Duplicate packets from node %d: %d\n" %
+                    (source, self.duplicates[source]))
+        for source in sorted(self.late.keys()):
+            out.write("Late packets from node %d: %d\n" %
+                    (source, self.late[source]))
+
+
+    def write(self, out):
+        """Write a raw copy of all traces to the file object out."""
+        write_traces(self.traces, out)
+
+
     def __str__(self):
         """Print a raw copy of all traces."""
-        out_string = ""
-        for id in self.traces.keys():
-            out_string += "Trace for node %d:\n" % (id)
-            for packet in self.traces[id]:
-                if packet:
-                    out_string += "    " + str(packet) + "\n"
-                else:
-                    out_string += "    " + "MISSING DATA\n"
-        return out_string
+        out = cStringIO.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+
+class SpooledTrace:
+    """Trace of one source kept in a temporary file.
+
+    Iterating over a SpooledTrace reads the trace back from the start.
+    Only one iteration over a trace may be in progress at a time.
+    """
+
+    # Each packet is a record header followed by its payload.  The
+    # header holds the timestamp, which is NaN if missing, and the
+    # destination address, number of bits, sequence number, and payload
+    # length.  A record with a length of GAP marks missing data.
+    RECORD = struct.Struct("<dHBBB")
+    GAP = 0xFF
+
+    def __init__(self, source):
+        self.source = source
+        self.file = tempfile.TemporaryFile()
+
+
+    def append(self, packet):
+        if packet == None:
+            self.file.write(self.RECORD.pack(0.0, 0, 0, 0, self.GAP))
+            return
+        timestamp = packet.timestamp
+        if timestamp == None:
+            timestamp = float("nan")
+        self.file.write(self.RECORD.pack(timestamp, packet.dst_addr,
+            packet.num_bits, packet.seq_num, len(packet.payload)))
+        self.file.write(str(bytearray(packet.payload)))
+
+
+    def __iter__(self):
+        self.file.flush()
+        self.file.seek(0)
+        while True:
+            header = self.file.read(self.RECORD.size)
+            if not header:
+                break
+            (timestamp, dst_addr, num_bits, seq_num, length) = \
+                    self.RECORD.unpack(header)
+            if length == self.GAP:
+                yield None
+                continue
+            if timestamp != timestamp:
+                timestamp = None
+
+            # Rebuild the Bitlog payload that BitlogPacket unpacks
+            payload = bytearray((num_bits, seq_num, self.source & 0xFF,
+                self.source >> 8))
+            payload.extend(self.file.read(length))
+            yield packet_module.BitlogPacket(packet_module.Packet(dst_addr,
+                self.source, packet_module.BitlogPacket.BITLOG_ID, payload,
+                timestamp))
+
+
+class SpooledTraces:
+    """Per-source traces sequenced by SourceTrace and kept on disk.
+
+    Packets are read and sequenced in a single pass.  Each packet is
+    written to a temporary file for its source as soon as it is placed
+    rather than being held in memory, so memory use is bounded by the
+    reorder and duplicate windows of SourceTrace however long the trace
+    is.  The traces dictionary maps each source to a SpooledTrace that
+    generates the packets of its trace, with None marking missing data,
+    so the traces can be decoded the same way as those of SourceTrace.
+    """
+
+    def __init__(self, packets):
+
+        self.source_trace = SourceTrace()
+        self.traces = {}
+        for (source, packet) in self.source_trace.sequence(packets):
+            trace = self.traces.get(source)
+            if trace == None:
+                trace = self.traces[source] = SpooledTrace(source)
+            trace.append(packet)
+
+
+    def get_start_time(self):
+        return self.source_trace.get_start_time()
+
+
+    def write_dropped(self, out):
+        self.source_trace.write_dropped(out)
+
+
+    def write(self, out):
+        """Write a raw copy of all traces to the file object out."""
+        write_traces(self.traces, out)
+
+
+def write_traces(traces, out):
+    """Write a raw copy of the traces dictionary to the file object out."""
+
+    for id in traces.keys():
+        out.write("Trace for node %d:\n" % (id))
+        for packet in traces[id]:
+            if packet:
+                out.write("    %s\n" % packet)
+            else:
+                out.write("    MISSING DATA\n")
 
 
 
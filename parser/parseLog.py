@@ -38,11 +38,19 @@
 import sys
 from optparse import OptionParser
 import copy
+import cStringIO
+import bisect
+import heapq
+import itertools
+import collections
+import multiprocessing
 
 import packet
 import packetTrace
 import rlisTokens
 import chunkStream
+import traceIndex
+import eventColumns
 
 def debug_out(text):
     """Minimal debugging output."""
@@ -52,6 +60,91 @@ def debug_out(text):
     return
 
 
+# RoiParser used by each process in a tokenize_traces process pool
+_worker_parser = None
+
+def _init_tokenize_worker(token_table):
+    """Create the RoiParser used by a process pool worker."""
+    global _worker_parser
+    _worker_parser = RoiParser(token_table)
+
+
+def _tokenize_chunk(chunk_work):
+    """Tokenize a single chunk of a trace within a process pool worker.
+
+    The chunk_work is (chunk, start_time, block), where block is the
+    number of the chunk within its trace used in error messages.
+    """
+    (chunk, start_time, block) = chunk_work
+    return list(_worker_parser.generate_tokens(chunk, start_time, block))
+
+
+class ScanCandidate:
+    """Partial parse of a chunk starting from a candidate offset."""
+
+    def __init__(self, offset, stream):
+        self.offset = offset
+        self.stream = stream
+        self.call_stack = []
+
+        # Running inputs to the heuristic score
+        self.num_tokens = 0
+        self.double_global = 0
+        self.call_depth = 0
+
+
+    def add_token(self, token):
+        """Account for the next token parsed by this candidate."""
+
+        # Number of tokens is good
+        self.num_tokens += 1
+
+        # Skip over watch points
+        if isinstance(token, rlisTokens.WatchEvent):
+            return
+
+        # Global IDs encountered from a non-zero depth call stack are
+        # avoided.  These imply one of:
+        # - Interuption while within an ROI by an interrupt that we are
+        #   also tracking.  (rarely observed in current data sets).
+        # - Parsing error.
+        # - Call to an entry function from within the ROI.  These
+        #   happen, but this heuristic implementation assumes that they
+        #   don't happen that often.
+        if token.type == rlisTokens.RlisEntry.HEADER and \
+                token.scope == rlisTokens.RlisEntry.GLOBAL and \
+                self.call_depth > 0:
+            self.double_global += 1
+
+        if (token.type == rlisTokens.RlisEntry.HEADER and
+                token.scope == rlisTokens.RlisEntry.GLOBAL
+                ) or (
+                token.type == rlisTokens.RlisEntry.CALL and
+                token.scope == rlisTokens.RlisEntry.LOCAL):
+            self.call_depth += 1
+        elif token.type == rlisTokens.RlisEntry.FOOTER and \
+                token.scope == rlisTokens.RlisEntry.POINT:
+            self.call_depth = max(self.call_depth - 1, 0)
+
+
+    def score(self):
+        """Heuristic score of the tokens parsed so far.
+
+        Many tokens and a small offset are good.
+        """
+
+        # NOTE: This is a heuristic that has been determined to work
+        # well for the ROI traces examined so far.  But this is ONLY a
+        # heuristic.  YMMV.
+        return self.num_tokens - self.offset - (10 * self.double_global)
+
+
+    def state(self):
+        """Everything that determines how the rest of the chunk parses."""
+        return (self.stream.bit_index, tuple(self.call_stack),
+                self.call_depth)
+
+
 class RoiParser:
 
     INDENT = "    "
@@ -67,73 +160,136 @@ class RoiParser:
 
 
     def _indented_time(self, time, bit_offset, depth):
-        out_string = ""
-        out_string += "%4.6f %3d: " % (time, bit_offset)
-        out_string += self.INDENT * depth
-        return out_string
+        return "%4.6f %3d: %s" % (time, bit_offset, self.INDENT * depth)
 
 
-    def _print_tokens(self, tokens_and_times):
-        out_string = ""
+    def _format_token(self, token, time_and_offset, call_depth):
+        """Format a single decoded token.
+
+        Returns the formatted line and the call depth after the token.
+        """
+
+        if isinstance(token, rlisTokens.WatchEvent):
+            data = token.data
+            token = token.token
+
+        # A RETURN is printed at the depth of the matching ENTRY
+        if token.type == rlisTokens.RlisEntry.FOOTER:
+            prefix = self._indented_time(time_and_offset[0],
+                    time_and_offset[1], call_depth - 1)
+        else:
+            prefix = self._indented_time(time_and_offset[0],
+                    time_and_offset[1], call_depth)
+
+        if token.type == rlisTokens.RlisEntry.FOOTER:
+            line = "<-- RETURN --\n"
+            call_depth -= 1
+
+        elif token.type == rlisTokens.RlisEntry.HEADER:
+            line = "-- ENTRY --> %s\n" % token.function_name
+            call_depth += 1
+
+        elif token.type == rlisTokens.RlisEntry.CALL:
+            if self.token_table.has_point_footer(token.target):
+                line = "-- BODY --> %s\n" % token.target
+                call_depth += 1
+            else:
+                line = "Calling %s\n" % token.target
+
+        elif token.type == rlisTokens.RlisEntry.CONDITIONAL:
+            line = "Branch ID: %d (of %d)\n" % (token.id, token.range)
+
+        elif token.type == rlisTokens.RlisEntry.WATCH:
+            line = "Watch point for %s with value: %d\n" % (
+                    token.watch_var, data)
+
+        else:
+            debug_out(token)
+            line = "Non-ROI token encountered.\n"
+
+        return (prefix + line, call_depth)
+
+
+    def write_tokens(self, tokens_and_times, out):
+        """Write the formatted tokens_and_times to the file object out.
+
+        Lines are written as they are formatted, so tokens_and_times may
+        be a generator and the output is never held in memory.
+        """
 
         call_depth = 0
         for (token, time_and_offset) in tokens_and_times:
 
             if not token:
-                out_string += "\n\nEND OF CHUNK\n\n"
+                out.write("\n\nEND OF CHUNK\n\n")
                 call_depth = 0
                 continue
-            elif type(token) == tuple:
-                # TODO: Badness to deal with possible tuple generated by
-                # the watch token type.
-                data = token[1]
-                token = token[0]
 
-            out_string += self._indented_time(time_and_offset[0],
-                    time_and_offset[1], call_depth)
+            (token_string, call_depth) = self._format_token(token,
+                    time_and_offset, call_depth)
+            out.write(token_string)
 
-            if token.type == rlisTokens.RlisEntry.FOOTER:
-                out_string = out_string[:-len(self.INDENT)]
-                out_string += "<-- RETURN --\n"
-                call_depth -= 1
+        out.write("\n\nEND OF DATA\n\n")
 
-            elif token.type == rlisTokens.RlisEntry.HEADER:
-                out_string += "-- ENTRY --> %s\n" % token.function_name
-                call_depth += 1
 
-            elif token.type == rlisTokens.RlisEntry.CALL:
-                if self.token_table.has_point_footer(token.target):
-                    out_string += "-- BODY --> %s\n" % token.target
-                    call_depth += 1
-                else:
-                    out_string += "Calling %s\n" % token.target
+    def _print_tokens(self, tokens_and_times):
+        out = cStringIO.StringIO()
+        self.write_tokens(tokens_and_times, out)
+        return out.getvalue()
 
-            elif token.type == rlisTokens.RlisEntry.CONDITIONAL:
-                out_string += "Branch ID: %d (of %d)\n" % (
-                        token.id, token.range)
+    def _processes_next_token(self, stream, call_stack):
+        """Decode the next token in stream and update call_stack.
 
-            elif token.type == rlisTokens.RlisEntry.WATCH:
-                out_string += "Watch point for %s with value: %d\n" % (
-                        token.watch_var, (int(data, 2)))
+        Tokens are decoded with the precompiled decode table for the
+        current context.  The table is indexed by the next table_width
+        bits, so near the end of a chunk, or if the context has no
+        table, the token is decoded one field at a time instead.
+        """
 
-            else:
-                debug_out(token)
-                out_string += "Non-ROI token encountered.\n"
+        time_and_offset = stream.read_time()
 
-        out_string += "\n\nEND OF DATA\n\n"
-        return out_string
+        if call_stack:
+            context = call_stack[-1]
+        else:
+            context = None
+        (table_width, table) = self.token_table.get_decode_table(context)
+
+        try:
+            if table_width == None:
+                raise chunkStream.DataMissing("No decode table")
+            index = stream.peek_bytes(table_width)
+        except (chunkStream.DataMissing, chunkStream.DataEnd):
+            return self._decode_next_token(stream, call_stack, time_and_offset)
+
+        entry = table[index]
+        if entry == None:
+            raise KeyError(index)
+        (width, token, stack_action, push_name) = entry
+        stream.skip_bytes(width)
+
+        # Maintain context
+        if stack_action == rlisTokens.TokenTable.STACK_POP:
+            from_function = call_stack.pop()
+        elif stack_action == rlisTokens.TokenTable.STACK_PUSH:
+            call_stack.append(push_name)
 
-    def _processes_next_token(self, stream, call_stack):
+        if token.type == rlisTokens.RlisEntry.WATCH:
+            data = stream.read_bytes(token.var_width)
+            token = rlisTokens.WatchEvent(token, data)
 
-        out_string = ""
+        return (token, call_stack, time_and_offset)
 
-        time_and_offset = stream.read_time()
 
-        # TODO: Magic number 2 :-(  Perhaps something like
-        # RlisEntry.MAX_PREAMBLE_LENGTH?
-        peek = stream.peek_bytes(2)
+    def _decode_next_token(self, stream, call_stack, time_and_offset):
+        """Decode the next token one field at a time."""
+
+        out_string = ""
+
+        peek = stream.peek_bytes(rlisTokens.RlisEntry.MAX_PREAMBLE_WIDTH)
+        peek_width = rlisTokens.RlisEntry.MAX_PREAMBLE_WIDTH
 
-        if peek[0] == rlisTokens.RlisEntry.POINT_PREAMBLE:
+        if peek >> (peek_width - rlisTokens.RlisEntry.POINT_PREAMBLE_WIDTH) == \
+                rlisTokens.RlisEntry.POINT_PREAMBLE:
 
             # Handle a point token.  Note that only a generic POINT
             # token is worked with.
@@ -144,10 +300,9 @@ class RoiParser:
         elif peek == rlisTokens.RlisEntry.GLOBAL_PREAMBLE:
 
             # Handle a global token
-            stream.read_bytes(len(rlisTokens.RlisEntry.GLOBAL_PREAMBLE))
+            stream.read_bytes(rlisTokens.RlisEntry.GLOBAL_PREAMBLE_WIDTH)
             id_width = self.token_table.global_token_width
-            id_str = stream.read_bytes(id_width)
-            id = int(id_str, 2)
+            id = stream.read_bytes(id_width)
             token = self.token_table.get_token(rlisTokens.RlisEntry.GLOBAL, id, None)
 
             # Maintain context
@@ -165,11 +320,10 @@ class RoiParser:
         elif peek == rlisTokens.RlisEntry.LOCAL_PREAMBLE:
 
             # Handle a local token
-            stream.read_bytes(len(rlisTokens.RlisEntry.LOCAL_PREAMBLE))
+            stream.read_bytes(rlisTokens.RlisEntry.LOCAL_PREAMBLE_WIDTH)
             context = call_stack[-1]
             id_width = self.token_table.local_token_widths[context]
-            id_str = stream.read_bytes(id_width)
-            id = int(id_str, 2)
+            id = stream.read_bytes(id_width)
             token = self.token_table.get_token(rlisTokens.RlisEntry.LOCAL, id, context)
 
             # Maintain context
@@ -183,11 +337,8 @@ class RoiParser:
             return out_string
 
         if token.type == rlisTokens.RlisEntry.WATCH:
-            # TODO: Overloading the type returned by this function to be
-            # either a token or a value.  A little ugly.  Clean this up
-            # later.
             data = stream.read_bytes(token.var_width)
-            token = (token, data)
+            token = rlisTokens.WatchEvent(token, data)
 
         assert token, "Token should be set before return"
         return (token, call_stack, time_and_offset)
@@ -195,106 +346,106 @@ class RoiParser:
 
     def _scan_chunk(self, clean_stream):
         """Examine a single chunk to find the best offset for parsing
-        that chunk."""
+        that chunk.
+
+        Each candidate offset is decoded one token at a time, always
+        advancing the candidate that is furthest behind in the stream.
+        Candidates that fail to parse are dropped as soon as they fail.
+        Two candidates that reach the same bit with the same parse state
+        will decode identical tokens from that point on, so only the one
+        with the better heuristic score so far is kept.  Candidates
+        quickly converge onto the same token boundaries, so the chunk is
+        decoded close to once rather than once per offset.
+        """
+
+        return self._best_offset(self._scan_candidates(clean_stream))
+
+
+    def _scan_candidates(self, clean_stream):
+        """Return the candidates of _scan_chunk that parse to the end of
+        the chunk without errors, in order of their offsets."""
 
         MAX_OFFSET = 100
+
+        # Live candidates indexed by offset and by parse state, plus a
+        # heap ordering the candidates by their position in the stream
+        candidates = {}
+        states = {}
+        heap = []
         guesses = []
 
         for offset in range(MAX_OFFSET):
             stream = copy.copy(clean_stream)
-            call_stack = []
-            tokens = []
             try:
                 # Drop the leading offset bytes
                 stream.read_bytes(offset)
+            except (chunkStream.DataMissing, chunkStream.DataEnd):
+                break
+            candidate = ScanCandidate(offset, stream)
+            candidates[offset] = candidate
+            states[candidate.state()] = candidate
+            heapq.heappush(heap, (stream.bit_index, offset))
+
+        while heap:
+            (bit_index, offset) = heapq.heappop(heap)
+            candidate = candidates.get(offset)
+            if candidate == None:
+                # Stale entry for a candidate that was merged away
+                continue
+            del states[candidate.state()]
 
-                while True:
-                    (token, call_stack, time_and_offset) = self._processes_next_token(stream, call_stack)
-                    tokens.append(token)
+            try:
+                (token, candidate.call_stack, time_and_offset) = \
+                        self._processes_next_token(candidate.stream,
+                                candidate.call_stack)
+                candidate.add_token(token)
 
-            except chunkStream.DataMissing:
+            except (chunkStream.DataMissing, chunkStream.DataEnd):
                 # This excetpion is a good sign, since it means we
                 # reached the end of a chunk without parsing errors.
                 # Use the current offest to parse the block.
-                if tokens != []:
-                    guesses.append((offset, tokens))
-
-            except chunkStream.DataEnd:
-                # This excetpion is a good sign, since it means we
-                # reached the end of the LAST chenk without parsing
-                # errors.  Use the current offest to parse the block.
-                if tokens != []:
-                    guesses.append((offset, tokens))
-
-            except IndexError:
-                # Bad parse attempt
+                del candidates[offset]
+                if candidate.num_tokens > 0:
+                    guesses.append(candidate)
                 continue
 
-            except KeyError:
+            except (IndexError, KeyError):
                 # Bad parse attempt
+                del candidates[offset]
                 continue
 
+            # Merge with any candidate already in the same parse state
+            state = candidate.state()
+            other = states.get(state)
+            if other != None:
+                if (other.score(), -other.offset) >= \
+                        (candidate.score(), -candidate.offset):
+                    del candidates[offset]
+                    continue
+                del candidates[other.offset]
+
+            states[state] = candidate
+            heapq.heappush(heap, (candidate.stream.bit_index, offset))
+
+        return sorted(guesses, key=lambda g: g.offset)
+
+
+    def _best_offset(self, guesses):
+        """Return the offset of the best scoring of guesses, or None."""
+
         best_offset = None
         best_score = None
-        for (guess_offset, guess_tokens) in guesses:
-            score = self._heuristic_score(guess_offset, guess_tokens)
+        for guess in guesses:
+            score = guess.score()
             if best_score == None:
                 # Force setting best_score if it has not yet been set
                 best_score = score - 1
             if score > best_score:
-                best_offset = guess_offset
+                best_offset = guess.offset
                 best_score = score
 
         return best_offset
 
-    def _heuristic_score(self, offset, tokens):
-        # Determine how "good" a match a given parse of a block is by
-        # examining the offset used and resulting parsed tokens.
-        #
-        # NOTE: This is a heuristic that has been determined to work
-        # well for the ROI traces examined so far.  But this is ONLY a
-        # heuristic.  YMMV.
-
-        # Number of tokens is good
-        num_tokens = len(tokens)
-
-        # Small offset is good
-        offset = offset
-
-        # Global IDs encountered from a non-zero depth call stack are
-        # avoided.  These imply one of:
-        # - Interuption while within an ROI by an interrupt that we are
-        #   also tracking.  (rarely observed in current data sets).
-        # - Parsing error.
-        # - Call to an entry function from within the ROI.  These
-        #   happen, but this heuristic implementation assumes that they
-        #   don't happen that often.
-        double_global = 0
-        call_depth = 0
-        for token in tokens:
-
-            # Skip over watch points that are a tuple type
-            if type(token) == type(()):
-                continue
-
-            if token.type == rlisTokens.RlisEntry.HEADER and \
-                    token.scope == rlisTokens.RlisEntry.GLOBAL and \
-                    call_depth > 0:
-                double_global += 1
-
-            if (token.type == rlisTokens.RlisEntry.HEADER and
-                    token.scope == rlisTokens.RlisEntry.GLOBAL
-                    ) or (
-                    token.type == rlisTokens.RlisEntry.CALL and
-                    token.scope == rlisTokens.RlisEntry.LOCAL):
-                call_depth += 1
-            elif token.type == rlisTokens.RlisEntry.FOOTER and \
-                    token.scope == rlisTokens.RlisEntry.POINT:
-                call_depth = max(call_depth - 1, 0)
-
-        return num_tokens - offset - (10 * double_global)
-
-
     def print_roi_call_trace(self, trace, start_time=0):
 
         tokens_and_times = self.tokenize_trace(trace, start_time)
@@ -329,47 +480,176 @@ class RoiParser:
           different location.
         """
 
-        stream = chunkStream.ChunkStream(trace, start_time)
-        tokens_and_times = []
+        return list(self.generate_tokens(trace, start_time))
 
-        while True:
 
-            # Add marker (None, None) noting that a new chunk has been
-            # entered
-            if tokens_and_times != []:
-                tokens_and_times.append((None, None))
+    def generate_tokens(self, trace, start_time=0, first_block=0):
+        """Generate the (token, time_and_offset) pairs of tokenize_trace
+        one at a time as the trace is decoded.
 
-            offset = self._scan_chunk(stream)
+        The trace may be any iterable of packets and None markers, such
+        as a SpooledTrace, and is read lazily.  Each chunk is decoded by
+        a ChunkDecoder, so memory use does not grow with the length of
+        the trace.  Chunks are numbered from first_block in messages.
+        """
 
-            # Log how many bits were dropped when scanning the block
-            if offset == None:
-                sys.stderr.write("Dropped bits: %d\n" %
-                        len(stream.chunks[stream.chunk_index]))
+        decoder = ChunkDecoder(self, start_time, first_block)
+        for p in trace:
+            if p:
+                decoded = decoder.add_packet(p)
             else:
-                sys.stderr.write("Dropped bits: %d\n" % offset)
+                decoded = decoder.end_chunk()
+            for token_and_time in decoded:
+                yield token_and_time
+        for token_and_time in decoder.end_chunk():
+            yield token_and_time
+
+
+    def tokenize_traces(self, traces, start_time=0, jobs=1):
+        """Tokenize each trace in the traces dictionary.
+
+        Generates (trace_id, tokens_and_times) pairs in sorted order of
+        trace_id, where tokens_and_times generates the pairs returned by
+        tokenize_trace.  Each tokens_and_times must be consumed before
+        the next pair is taken.
+
+        If jobs is greater than one then the chunks of every trace are
+        tokenized in parallel by a pool of jobs processes.  This is
+        possible since the call stack is restarted at the start of each
+        chunk.  Chunks are read lazily and at most 2 * jobs chunks are
+        in progress at a time.  Results are identical to calling
+        tokenize_trace on each trace.
+        """
 
-            if offset == None:
-                sys.stderr.write("Sync error on block %d\n" % stream.chunk_index)
-                if not stream.next_chunk(): break
+        trace_ids = sorted(traces.keys())
+
+        if jobs <= 1:
+            for trace_id in trace_ids:
+                yield (trace_id, self.generate_tokens(traces[trace_id],
+                    start_time))
+            return
+
+        pool = multiprocessing.Pool(jobs, _init_tokenize_worker,
+                (self.token_table,))
+        try:
+            results = self._tokenize_chunks(pool, 2 * jobs, traces,
+                    trace_ids, start_time)
+            for (trace_id, trace_results) in itertools.groupby(results,
+                    lambda result: result[0]):
+                yield (trace_id, self._join_chunks(trace_results))
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def _tokenize_chunks(self, pool, max_pending, traces, trace_ids,
+            start_time):
+        """Generate (trace_id, chunk_tokens) for each chunk of the traces
+        in order, tokenizing up to max_pending chunks at a time in pool.
+
+        Chunks without any bits are not tokenized and have chunk_tokens
+        of None.  The other chunks are numbered within their trace as
+        generate_tokens numbers them.
+        """
+
+        pending = collections.deque()
+        for trace_id in trace_ids:
+            block = 0
+            for chunk in chunkStream.split_trace(traces[trace_id]):
+                if not [p for p in chunk if p.bit_value()[1] > 0]:
+                    pending.append((trace_id, None))
+                else:
+                    pending.append((trace_id, pool.apply_async(
+                        _tokenize_chunk, ((chunk, start_time, block),))))
+                    block += 1
+                while len(pending) > max_pending:
+                    yield self._pending_result(pending.popleft())
+        while pending:
+            yield self._pending_result(pending.popleft())
+
+
+    def _pending_result(self, pending):
+        (trace_id, result) = pending
+        if result == None:
+            return (trace_id, None)
+        return (trace_id, result.get())
+
+
+    def _join_chunks(self, chunk_results):
+        """Join the (trace_id, chunk_tokens) results of the chunks of one
+        trace into its (token, time_and_offset) pairs.
+
+        A (None, None) marker is placed before each chunk following the
+        first chunk that produced tokens, matching generate_tokens.
+        """
+
+        generated = False
+        for (trace_id, chunk_tokens) in chunk_results:
+            if chunk_tokens == None:
                 continue
+            if generated:
+                yield (None, None)
+            for token_and_time in chunk_tokens:
+                generated = True
+                yield token_and_time
 
-            call_stack = []
-            try:
-                # Drop the leading offet bytes
-                stream.read_bytes(offset)
 
-                while True:
-                    (token, tmp_stack, time_and_offset) = self._processes_next_token(stream, call_stack)
-                    tokens_and_times.append((token, time_and_offset))
+    def timeline_events(self, trace_id, tokens_and_times):
+        """Generate (time, trace_id, index, line) for each formatted line
+        of a trace.
 
-            except chunkStream.DataMissing:
-                if not stream.next_chunk(): break
+        The index numbers the lines of the trace so that lines with
+        equal times keep their order when timelines are merged.
+        """
 
-            except chunkStream.DataEnd:
-                assert not stream.next_chunk()
-                break
+        call_depth = 0
+        time = 0
+        index = 0
+        for (token, time_and_offset) in tokens_and_times:
 
-        return tokens_and_times
+            if not token:
+                line = "END OF CHUNK\n"
+                call_depth = 0
+            else:
+                time = time_and_offset[0]
+                (line, call_depth) = self._format_token(token,
+                        time_and_offset, call_depth)
+
+            yield (time, trace_id, index, line)
+            index += 1
+
+        yield (time, trace_id, index, "END OF DATA\n")
+
+
+    def merge_timelines(self, traces, start_time=0):
+        """Generate the lines of all traces merged into one timeline.
+
+        Each trace is decoded lazily and the traces are combined with a
+        k-way merge, so only one pending line per trace is held in
+        memory.  Lines are generated as (time, trace_id, index, line)
+        ordered by time, and then by trace_id.
+        """
+
+        timelines = [self.timeline_events(trace_id,
+            self.generate_tokens(traces[trace_id], start_time))
+            for trace_id in sorted(traces.keys())]
+        return heapq.merge(*timelines)
+
+
+    def tokenize_columns(self, traces, start_time=0, jobs=1):
+        """Tokenize each trace in the traces dictionary into columns.
+
+        Returns an EventColumns holding the events of every trace in
+        sorted order of trace_id.  The events of each trace are added as
+        they are decoded by generate_tokens, so no list of tuples is
+        built for the trace.
+        """
+
+        columns = eventColumns.EventColumns(self.token_table)
+        for (trace_id, tokens_and_times) in self.tokenize_traces(
+                traces, start_time, jobs):
+            columns.add_trace(trace_id, tokens_and_times)
+        return columns
 
 
     def __str__(self):
@@ -381,6 +661,379 @@ class RoiParser:
         return out_string
 
 
+class ChunkDecoder:
+    """Decode the chunks of a trace from a bounded window of packets.
+
+    Packets of a trace are added one at a time and each call returns
+    the (token, time_and_offset) pairs that could be decoded so far.
+    Once SCAN_PACKETS packets of a chunk, or the whole chunk if it is
+    shorter, have been added they are scanned for the offset to decode
+    the chunk from.  While the scan can not decide between offsets the
+    window is doubled, up to MAX_SCAN_PACKETS packets.  After that the
+    chunk is decoded DECODE_PACKETS packets at a time and packets are
+    dropped as soon as all of their bits are decoded.
+
+    Chunks no longer than the scan window are decoded exactly as if the
+    whole chunk were scanned at once.  If the data of a longer chunk
+    stops parsing after the scan window, the chunk is synchronized again
+    from the following packet.
+    """
+
+    SCAN_PACKETS = 32
+    MAX_SCAN_PACKETS = 1024
+    DECODE_PACKETS = 64
+
+    def __init__(self, roi_parser, start_time, first_block=0):
+
+        self.roi_parser = roi_parser
+        self.start_time = start_time
+
+        # Number of the current chunk among the chunks holding bits
+        self.block = first_block
+
+        # Set once any token of the trace has been decoded
+        self.generated = False
+
+        self._reset()
+
+
+    def _reset(self):
+        """Forget all state from the current chunk."""
+
+        # Packets of the current chunk that are not yet fully decoded,
+        # the number of bits they hold, and the number of bits of the
+        # chunk before them
+        self.packets = []
+        self.packet_bits = 0
+        self.bit_base = 0
+
+        # Number of bits in the chunk so far
+        self.chunk_bits = 0
+
+        # Offset into packets of the next bit to decode, or None if the
+        # chunk has not yet been synchronized
+        self.bit_index = None
+        self.call_stack = []
+        self.scan_packets = self.SCAN_PACKETS
+
+        # Set if tokens were decoded since the chunk was synchronized
+        self.synced_tokens = False
+
+        # Set once the rest of the chunk can not be synchronized
+        self.lost = False
+
+
+    def add_packet(self, p):
+        """Add the next packet of the current chunk."""
+
+        decoded = []
+        num_bits = p.bit_value()[1]
+        if num_bits > 0 and self.chunk_bits == 0 and self.generated:
+            # Marker noting that a new chunk has been entered
+            decoded.append((None, None))
+        self.chunk_bits += num_bits
+        if self.lost:
+            return decoded
+
+        self.packets.append(p)
+        self.packet_bits += num_bits
+        if self.bit_index == None:
+            if len(self.packets) >= self.scan_packets:
+                self._scan(False, decoded)
+        elif len(self.packets) >= self.DECODE_PACKETS:
+            self._decode(decoded)
+        return decoded
+
+
+    def end_chunk(self):
+        """Decode the rest of the current chunk and start a new one."""
+
+        decoded = []
+        if self.chunk_bits > 0:
+            if self.bit_index == None and not self.lost:
+                self._scan(True, decoded)
+            if self.bit_index != None:
+                self._decode(decoded)
+            if self.lost:
+                sys.stderr.write("Dropped bits: %d on block %d\n" %
+                        (self.chunk_bits - self.bit_base, self.block))
+                sys.stderr.write("Sync error on block %d\n" % self.block)
+            self.block += 1
+        self._reset()
+        return decoded
+
+
+    def _stream(self):
+        return chunkStream.ChunkStream(self.packets, self.start_time,
+                self.bit_base)
+
+
+    def _scan(self, chunk_done, decoded):
+        """Find the offset to decode the buffered packets from."""
+
+        if self.packet_bits == 0:
+            return
+
+        guesses = self.roi_parser._scan_candidates(self._stream())
+        if len(guesses) > 1 and not chunk_done and \
+                len(self.packets) < self.MAX_SCAN_PACKETS:
+            # Wait for more data to choose between the offsets
+            self.scan_packets = min(2 * len(self.packets),
+                    self.MAX_SCAN_PACKETS)
+            return
+
+        offset = self.roi_parser._best_offset(guesses)
+        if offset == None:
+            self.lost = True
+            self.packets = []
+            self.packet_bits = 0
+            return
+
+        sys.stderr.write("Dropped bits: %d on block %d\n" %
+                (offset, self.block))
+        self.bit_index = offset
+        self.call_stack = []
+        if not chunk_done:
+            self._decode(decoded)
+
+
+    def _decode(self, decoded):
+        """Decode all complete tokens in the buffered packets."""
+
+        if self.packet_bits == 0:
+            return
+
+        stream = self._stream()
+        stream.bit_index = self.bit_index
+        while True:
+            token_start = stream.bit_index
+            try:
+                (token, self.call_stack, time_and_offset) = \
+                        self.roi_parser._processes_next_token(stream,
+                                self.call_stack)
+            except (chunkStream.DataMissing, chunkStream.DataEnd):
+                # Wait for the rest of the token to arrive
+                stream.bit_index = token_start
+                break
+            except (IndexError, KeyError):
+                self._resync(stream.time_offsets[0], token_start, decoded)
+                return
+
+            self.generated = True
+            self.synced_tokens = True
+            decoded.append((token, time_and_offset))
+
+        # Drop packets that have been completely decoded
+        offsets = stream.time_offsets[0]
+        packet_index = bisect.bisect_right(offsets, stream.bit_index) - 1
+        self._drop_packets(packet_index, offsets[packet_index])
+        self.bit_index = stream.bit_index - offsets[packet_index]
+
+
+    def _resync(self, offsets, token_start, decoded):
+        """Synchronize again after the packet holding token_start."""
+
+        sys.stderr.write("Sync error on block %d\n" % self.block)
+        packet_index = bisect.bisect_right(offsets, token_start)
+        if packet_index < len(offsets):
+            self._drop_packets(packet_index, offsets[packet_index])
+        else:
+            self._drop_packets(packet_index, self.packet_bits)
+        self.bit_index = None
+        self.call_stack = []
+        self.scan_packets = self.SCAN_PACKETS
+
+        # The call stack is restarted, so mark the end of the chunk
+        if self.synced_tokens:
+            decoded.append((None, None))
+            self.synced_tokens = False
+
+
+    def _drop_packets(self, count, bits):
+        """Drop the first count buffered packets holding bits bits."""
+
+        self.packets = self.packets[count:]
+        self.packet_bits -= bits
+        self.bit_base += bits
+
+
+class NodeFollowState:
+    """Decoding state kept for each node while following a live trace."""
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        """Forget all state from the current chunk."""
+
+        # Packets of the current chunk that are not yet fully decoded
+        self.packets = []
+
+        # Offset into packets of the first bit not yet decoded, or
+        # None if the stream has not yet been synchronized.
+        self.bit_index = None
+
+        self.call_stack = []
+        self.call_depth = 0
+
+
+class RoiFollower:
+    """Incrementally decode packets from a trace that is still growing.
+
+    Packets are sequenced per node as they arrive, and each node keeps
+    its own call stack.  Decoded tokens are written to out as soon as
+    all of their bits have been received.  Packets are discarded once
+    they are fully decoded, so memory use does not grow with the length
+    of the trace.
+    """
+
+    # Number of packets buffered before synchronizing on a new chunk
+    SYNC_PACKETS = 4
+
+    def __init__(self, roi_parser, out=sys.stdout):
+
+        self.roi_parser = roi_parser
+        self.out = out
+        self.start_time = None
+
+        # Only the most recent packet from each node is kept by the
+        # source trace.  This is enough to sequence new packets.
+        self.source_trace = packetTrace.SourceTrace([])
+        self.nodes = {}
+
+
+    def add_packet(self, packet):
+        """Sequence and decode a newly received packet."""
+
+        if self.start_time == None:
+            self.start_time = packet.timestamp
+
+        source = packet.src_addr
+        state = self.nodes.setdefault(source, NodeFollowState())
+
+        self._sequence(source, state, self.source_trace.add_packet, packet)
+        self.out.flush()
+
+
+    def finish(self):
+        """Decode any data still buffered once the input ends."""
+
+        for source in sorted(self.nodes.keys()):
+            state = self.nodes[source]
+            self._sequence(source, state, self.source_trace.flush_source,
+                    source)
+            if state.packets:
+                self._decode(source, state, True)
+            self._write(source, "END OF DATA\n")
+        self.out.flush()
+        self.source_trace.write_dropped(sys.stderr)
+
+
+    def _sequence(self, source, state, sequence_function, argument):
+        """Decode the packets placed in the trace of source by calling
+        sequence_function with argument.
+        """
+
+        prior_trace = self.source_trace.traces.get(source, [])
+        prior_length = len(prior_trace)
+        prior_last = prior_trace and prior_trace[-1]
+        sequence_function(argument)
+        trace = self.source_trace.traces[source]
+        new_packets = trace[prior_length:]
+        self.source_trace.traces[source] = trace[-1:]
+
+        # The last packet was replaced by a copy holding more bits after
+        # an early flush.  The copy starts with the same bits, so it can
+        # take the place of the buffered packet and decoding continues
+        # from the current bit.  If that packet is no longer buffered
+        # then the new bits can not be placed and the chunk ends.
+        if prior_last and trace[prior_length - 1] is not prior_last:
+            if state.packets and state.packets[-1] is prior_last:
+                state.packets[-1] = trace[prior_length - 1]
+                self._decode(source, state, False)
+            else:
+                self._end_chunk(source, state)
+                state.packets.append(trace[prior_length - 1])
+                self._decode(source, state, False)
+
+        for p in new_packets:
+            if p:
+                state.packets.append(p)
+                self._decode(source, state, False)
+            else:
+                self._end_chunk(source, state)
+
+
+    def _write(self, source, text):
+        self.out.write("Node %d: %s" % (source, text))
+
+
+    def _end_chunk(self, source, state):
+        """Flush the current chunk after missing packets are detected."""
+
+        if state.packets:
+            self._decode(source, state, True)
+        self._write(source, "END OF CHUNK\n")
+        state.reset()
+
+
+    def _decode(self, source, state, chunk_done):
+        """Decode all complete tokens buffered for a node."""
+
+        if state.bit_index == None:
+            if len(state.packets) < self.SYNC_PACKETS and not chunk_done:
+                return
+
+            stream = chunkStream.ChunkStream(state.packets, self.start_time)
+            offset = self.roi_parser._scan_chunk(stream)
+            if offset == None:
+                # Unable to synchronize.  Give up on the oldest packet
+                # and try again once more data arrives.
+                sys.stderr.write("Sync error on node %d\n" % source)
+                if chunk_done:
+                    state.packets = []
+                else:
+                    state.packets = state.packets[1:]
+                return
+
+            sys.stderr.write("Dropped bits: %d\n" % offset)
+            state.bit_index = offset
+
+        stream = chunkStream.ChunkStream(state.packets, self.start_time)
+        stream.bit_index = state.bit_index
+        while True:
+            token_start = stream.bit_index
+            try:
+                (token, state.call_stack, time_and_offset) = \
+                        self.roi_parser._processes_next_token(stream,
+                                state.call_stack)
+            except (chunkStream.DataMissing, chunkStream.DataEnd):
+                # Wait for the rest of the token to arrive
+                stream.bit_index = token_start
+                break
+            except (IndexError, KeyError):
+                # Lost synchronization.  Resynchronize using the data
+                # following the current packet.
+                sys.stderr.write("Sync error on node %d\n" % source)
+                state.bit_index = None
+                state.call_stack = []
+                state.call_depth = 0
+                state.packets = state.packets[1:]
+                return
+
+            (token_string, state.call_depth) = \
+                    self.roi_parser._format_token(token, time_and_offset,
+                            state.call_depth)
+            self._write(source, token_string)
+
+        # Drop packets that have been completely decoded
+        offsets = stream.time_offsets[0]
+        packet_index = bisect.bisect_right(offsets, stream.bit_index) - 1
+        state.packets = state.packets[packet_index:]
+        state.bit_index = stream.bit_index - offsets[packet_index]
+
+
 if __name__ == '__main__':
 
     # Handle the command line
@@ -389,11 +1042,38 @@ if __name__ == '__main__':
 
     parser.add_option("-m", "--mode", dest="mode", metavar="STRING",
             default="system", help="Specify the trace mode that " +
-            "may be either network or system [default: %default]")
+            "may be network, system, or binary [default: %default]")
 
     parser.add_option("-p", "--print", action="store_true",
             dest="print_packets", help="Only print the raw log packets")
 
+    parser.add_option("-j", "--jobs", dest="jobs", default=1,
+            type="int", help="Number of processes used to tokenize " +
+            "the traces [default: %default]")
+
+    parser.add_option("-f", "--follow", action="store_true",
+            dest="follow", help="Decode the trace as it is written, " +
+            "similar to tail -f.  Use - as the trace to read from stdin")
+
+    parser.add_option("-t", "--timeline", action="store_true",
+            dest="timeline", help="Merge the traces of all nodes into " +
+            "a single timeline ordered by time")
+
+    parser.add_option("-n", "--node", dest="node", default=None,
+            type="int", help="Only decode packets from this node")
+
+    parser.add_option("--from", dest="from_time", default=None,
+            type="float", metavar="SECONDS", help="Only decode packets " +
+            "logged at least this many seconds into the trace")
+
+    parser.add_option("--to", dest="to_time", default=None,
+            type="float", metavar="SECONDS", help="Only decode packets " +
+            "logged at most this many seconds into the trace")
+
+    parser.add_option("--no-cache", action="store_false", dest="use_cache",
+            default=True, help="Do not read or write side files such " +
+            "as the compiled token table and the trace index")
+
     (options, args) = parser.parse_args()
 
     if len(args) != 2:
@@ -402,31 +1082,85 @@ if __name__ == '__main__':
 
 
     # Read in the packets and make list of bitlog packets
-    if options.mode == "network":
-        packet_class = packet.AMPacket
-    elif options.mode == "system":
-        packet_class = packet.SystemPacket
+    if options.mode not in packet.TRACE_MODES:
+        parser.error("option -m must be one of network, system, or binary")
+
+    if options.timeline and options.jobs > 1:
+        parser.error("option -t decodes in one process and can not be " +
+                "used with -j")
+
+    # Decode packets as they arrive and exit if requested
+    if options.follow:
+        if options.mode == "binary":
+            parser.error("option -f can not be used with binary traces")
+        if options.node != None or options.from_time != None or \
+                options.to_time != None:
+            parser.error("option -f decodes every packet and can not be " +
+                    "used with -n, --from, or --to")
+        if options.jobs > 1 or options.timeline or options.print_packets:
+            parser.error("option -f can not be used with -j, -t, or -p")
+        token_table = rlisTokens.load_token_table(rlis_file,
+                options.use_cache)
+        follower = RoiFollower(RoiParser(token_table))
+        packets = packet.follow_packets(trace_file,
+                packet.TRACE_MODES[options.mode])
+        try:
+            for bitlog_packet in packet.BitlogPacket.get_bitlog_packets(packets):
+                follower.add_packet(bitlog_packet)
+        except KeyboardInterrupt:
+            pass
+        follower.finish()
+        sys.exit(0)
+
+    # Read only the selected packets using an index of the trace
+    if options.node != None or options.from_time != None or \
+            options.to_time != None:
+        try:
+            index = traceIndex.TraceIndex(trace_file, options.mode,
+                    options.use_cache)
+        except (IOError, OSError, packet.PacketFormatError), e:
+            parser.error("can not index %s: %s" % (trace_file, e))
+        start_time = index.get_start_time()
+        (start, end) = (None, None)
+        if start_time != None and options.from_time != None:
+            start = start_time + options.from_time
+        if start_time != None and options.to_time != None:
+            end = start_time + options.to_time
+        packets = index.packets(options.node, start, end)
+        bitlog_packets = packet.BitlogPacket.get_bitlog_packets(packets)
+        bitlog_traces = packetTrace.SpooledTraces(bitlog_packets)
     else:
-        parser.error("option -m must be either network or system")
-    packets = packet.read_packets(trace_file, packet_class)
-    bitlog_packets = packet.BitlogPacket.get_bitlog_packets(packets)
+        packets = packet.read_trace(trace_file, options.mode)
+        bitlog_packets = packet.BitlogPacket.get_bitlog_packets(packets)
 
-    # Create a source trace from the packets
-    bitlog_traces = packetTrace.SourceTrace(bitlog_packets)
-    start_time = bitlog_traces.get_start_time()
+        # Create a source trace from the packets
+        bitlog_traces = packetTrace.SpooledTraces(bitlog_packets)
+        start_time = bitlog_traces.get_start_time()
+
+    bitlog_traces.write_dropped(sys.stderr)
 
     # Print packets and exit if requested
     if options.print_packets:
-        print bitlog_traces
+        bitlog_traces.write(sys.stdout)
+        print
         sys.exit(0)
 
     # Initialize the token tables and parser
-    token_table = rlisTokens.TokenTable(rlis_file)
+    token_table = rlisTokens.load_token_table(rlis_file,
+            options.use_cache)
     roi_parser = RoiParser(token_table)
 
+    # Print all traces merged into one timeline and exit if requested
+    if options.timeline:
+        for (time, trace_id, index, line) in roi_parser.merge_timelines(
+                bitlog_traces.traces, start_time):
+            sys.stdout.write("Node %d: %s" % (trace_id, line))
+        sys.exit(0)
+
     # Print all traces
-    for trace_id in sorted(bitlog_traces.traces.keys()):
+    for (trace_id, tokens_and_times) in roi_parser.tokenize_traces(
+            bitlog_traces.traces, start_time, options.jobs):
         print "==== Trace for node %d ====" % (trace_id)
-        print roi_parser.print_roi_call_trace(
-                bitlog_traces.traces[trace_id], start_time)
+        roi_parser.write_tokens(tokens_and_times, sys.stdout)
+        print
         print
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009, Regents of the University of California
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# * Neither the name of the University of California, Los Angeles
+# nor the names of its contributors may be used to endorse or
+# promote products derived from this software without specific prior
+# written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Author: Roy Shea
+
+import sys
+import math
+from optparse import OptionParser
+import rlisTokens
+import packet
+import packetTrace
+import parseLog
+
+
+class LatencyHistogram:
+    """Streaming summary of a set of latencies.
+
+    Latencies are counted in logarithmic buckets that each span a factor
+    of RATIO, so percentiles are reported to within that factor while
+    memory stays bounded no matter how many latencies are added.
+    Latencies below MIN_LATENCY share a single bucket.
+    """
+
+    RATIO = 1.05
+    MIN_LATENCY = 1e-6
+
+    def __init__(self):
+
+        self.count = 0
+        self.total = 0.0
+        self.max_latency = 0.0
+        self.buckets = {}
+
+
+    def add(self, latency):
+
+        self.count += 1
+        self.total += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        if latency < self.MIN_LATENCY:
+            bucket = 0
+        else:
+            bucket = int(math.log(latency / self.MIN_LATENCY) /
+                    math.log(self.RATIO)) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket holding the percentile."""
+
+        rank = max(int(math.ceil(percent / 100.0 * self.count)), 1)
+        seen = 0
+        for bucket in sorted(self.buckets.keys()):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket == 0:
+                    upper = self.MIN_LATENCY
+                else:
+                    upper = self.MIN_LATENCY * self.RATIO ** bucket
+                return min(upper, self.max_latency)
+        return self.max_latency
+
+
+class FunctionProfile:
+    """Latency of the calls to a function or along a call edge."""
+
+    def __init__(self):
+
+        self.inclusive = LatencyHistogram()
+        self.exclusive = 0.0
+
+
+class LatencyProfile:
+    """Per-function and per-edge latency profile of decoded traces.
+
+    A function is entered by an ENTRY (a GLOBAL token in a HEADER) or a
+    BODY (a CALL to a function with a POINT footer) and exits at its
+    RETURN.  This matches the call depth tracked by parseLog.py.  The
+    inclusive time of a call runs from entry to return, and the exclusive
+    time omits the inclusive time of the calls made from it.  Calls that
+    are still open at the end of a chunk are discarded.
+
+    Packets only carry the time they were received.  The bits of a
+    packet were logged between the prior packet and this one, so the
+    time of each token is interpolated between the two packet times
+    using the bit offset of the token within its packet.
+    """
+
+    BITS_PER_PACKET = 8 * 16
+
+    def __init__(self, token_table):
+
+        self.token_table = token_table
+
+        # Profiles keyed by function name and by (caller, callee)
+        self.functions = {}
+        self.edges = {}
+
+
+    def add_trace(self, trace_id, tokens_and_times):
+        """Add the calls in a trace.
+
+        The tokens_and_times may be any iterable, such as the generator
+        returned by RoiParser.generate_tokens, and is consumed once.
+        """
+
+        # Open calls as [function, start time, time spent in callees]
+        call_stack = []
+        prior_packet_time = None
+        packet_time = None
+
+        for (token, time_and_offset) in tokens_and_times:
+
+            if not token:
+                call_stack = []
+                prior_packet_time = None
+                packet_time = None
+                continue
+            elif isinstance(token, rlisTokens.WatchEvent):
+                token = token.token
+
+            if time_and_offset[0] != packet_time:
+                if packet_time == None:
+                    prior_packet_time = time_and_offset[0]
+                else:
+                    prior_packet_time = packet_time
+                packet_time = time_and_offset[0]
+            fraction = min(time_and_offset[1], self.BITS_PER_PACKET) / \
+                    float(self.BITS_PER_PACKET)
+            time = prior_packet_time + \
+                    (packet_time - prior_packet_time) * fraction
+
+            if token.type == rlisTokens.RlisEntry.HEADER:
+                call_stack.append([token.function_name, time, 0.0])
+
+            elif token.type == rlisTokens.RlisEntry.CALL and \
+                    self.token_table.has_point_footer(token.target):
+                call_stack.append([token.target, time, 0.0])
+
+            elif token.type == rlisTokens.RlisEntry.FOOTER and call_stack:
+                (function_name, start, callee_time) = call_stack.pop()
+                latency = time - start
+                caller = None
+                if call_stack:
+                    call_stack[-1][2] += latency
+                    caller = call_stack[-1][0]
+                self._add_call(caller, function_name, latency,
+                        latency - callee_time)
+
+
+    def _add_call(self, caller, function_name, latency, exclusive):
+
+        profile = self.functions.get(function_name)
+        if profile == None:
+            profile = self.functions[function_name] = FunctionProfile()
+        profile.inclusive.add(latency)
+        profile.exclusive += exclusive
+
+        if caller != None:
+            edge = (caller, function_name)
+            profile = self.edges.get(edge)
+            if profile == None:
+                profile = self.edges[edge] = FunctionProfile()
+            profile.inclusive.add(latency)
+            profile.exclusive += exclusive
+
+
+    def write_report(self, out):
+        """Write the profile as two tables sorted by inclusive time."""
+
+        out.write("# Functions\n")
+        self._write_table(out, "function", self.functions,
+                lambda name: name)
+        out.write("\n# Caller -> callee\n")
+        self._write_table(out, "edge", self.edges,
+                lambda edge: "%s -> %s" % edge)
+
+
+    def _write_table(self, out, label, profiles, name_of):
+
+        names = sorted(profiles.keys(), key=lambda name:
+                (-profiles[name].inclusive.total, name))
+        out.write("# %-30s %8s %12s %12s %12s %12s %12s %12s\n" % (label,
+            "calls", "inclusive", "exclusive", "mean", "p50", "p90", "p99"))
+        for name in names:
+            profile = profiles[name]
+            latencies = profile.inclusive
+            out.write("%-32s %8d %12.6f %12.6f %12.6f %12.6f %12.6f %12.6f\n" %
+                    (name_of(name), latencies.count, latencies.total,
+                        profile.exclusive, latencies.mean(),
+                        latencies.percentile(50), latencies.percentile(90),
+                        latencies.percentile(99)))
+
+
+def main():
+
+    # Handle the command line
+    usage = "usage: %prog [options] rlis trace"
+    parser = OptionParser(usage)
+
+    parser.add_option("-m", "--mode", dest="mode", metavar="STRING",
+            default="system", help="Specify the trace mode that " +
+            "may be network, system, or binary [default: %default]")
+
+    parser.add_option("-n", "--node", dest="node_id", default=None,
+            type="int", help="Only profile the trace for node with " +
+            "specified identifier [default: all nodes]")
+
+    parser.add_option("--no-cache", action="store_false", dest="use_cache",
+            default=True, help="Do not read or write side files such " +
+            "as the compiled token table")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Must specify both the rlis and trace file names")
+    (rlis_file, trace_file) = args
+
+    # Read in the packets and make list of bitlog packets
+    if options.mode not in packet.TRACE_MODES:
+        parser.error("option -m must be one of network, system, or binary")
+    packets = packet.read_trace(trace_file, options.mode)
+    bitlog_packets = packet.BitlogPacket.get_bitlog_packets(packets)
+
+    # Create a source trace from the packets
+    bitlog_traces = packetTrace.SpooledTraces(bitlog_packets)
+
+    # Load the token table and the parser
+    token_table = rlisTokens.load_token_table(rlis_file,
+            options.use_cache)
+    roi_parser = parseLog.RoiParser(token_table)
+
+    # Profile the tokens of each node as they are decoded
+    profile = LatencyProfile(token_table)
+    start_time = bitlog_traces.get_start_time()
+    for trace_id in sorted(bitlog_traces.traces.keys()):
+        if options.node_id != None and trace_id != options.node_id:
+            continue
+        profile.add_trace(trace_id, roi_parser.generate_tokens(
+            bitlog_traces.traces[trace_id], start_time))
+
+    profile.write_report(sys.stdout)
+    bitlog_traces.write_dropped(sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -35,10 +35,22 @@
 
 # Author: Roy Shea
 
-import copy
+import hashlib
+import cStringIO
 
-class RlisEntry:
-    """Representation of an RLIS entry"""
+import sideFile
+
+class RlisEntry(object):
+    """Representation of an RLIS entry
+
+    Entries are compact slotted records that are shared by every decoded
+    event referring to them.  Treat entries as read only once they have
+    been added to a TokenTable.
+    """
+
+    __slots__ = ("type", "function_name", "scope", "id", "width",
+            "watch_var", "var_width", "target", "if_branch",
+            "switch_branch", "loop_branch", "range")
 
     # RLIS entry types
     CONDITIONAL = 1
@@ -57,10 +69,15 @@ class RlisEntry:
     LOCAL = 2
     GLOBAL = 3
 
-    # RLIS token preambles
-    POINT_PREAMBLE = "0"
-    LOCAL_PREAMBLE = "11"
-    GLOBAL_PREAMBLE= "10"
+    # RLIS token preambles stored as integer values along with the
+    # number of bits that each preamble occupies in the log
+    POINT_PREAMBLE = 0x0
+    LOCAL_PREAMBLE = 0x3
+    GLOBAL_PREAMBLE= 0x2
+    POINT_PREAMBLE_WIDTH = 1
+    LOCAL_PREAMBLE_WIDTH = 2
+    GLOBAL_PREAMBLE_WIDTH = 2
+    MAX_PREAMBLE_WIDTH = 2
 
     def __init__(self, rlis_entry):
         """Create an RLIS entry from a list of RLIS datums.
@@ -274,9 +291,59 @@ class RlisEntry:
         return out_string
 
 
+class RlisEntryOffset(object):
+    """View of a ranged RlisEntry resolved to a single identifier.
+
+    Ranged entries, such as conditionals, cover range consecutive
+    identifiers.  Rather than copying the entry for each identifier the
+    token table stores a view that shares all data with the base entry
+    and only records the offset of its identifier within the range.
+    """
+
+    __slots__ = ("base", "offset")
+
+    def __init__(self, base, offset):
+        self.base = base
+        self.offset = offset
+
+
+    def _get_id(self):
+        return self.base.id + self.offset
+    id = property(_get_id)
+
+
+    def __getattr__(self, name):
+        # Only reached for attributes not defined by the view itself
+        if name in RlisEntryOffset.__slots__:
+            raise AttributeError(name)
+        return getattr(self.base, name)
+
+
+    def __str__(self):
+        return RlisEntry.__str__.__func__(self)
+
+
+class WatchEvent(object):
+    """Decoded watch token along with the value logged for it."""
+
+    __slots__ = ("token", "data")
+
+    def __init__(self, token, data):
+        self.token = token
+        self.data = data
+
+
 class TokenTable:
     """TokenTable contains the information required to parse a BitlogTrace"""
 
+    # Effect that decoding a token has on the parser call stack
+    STACK_NONE = 0
+    STACK_POP = 1
+    STACK_PUSH = 2
+
+    # Largest number of index bits used for a decode table
+    MAX_DECODE_TABLE_WIDTH = 16
+
     def __init__(self, rlis_file):
         """Create token table using data in rlis_file.
 
@@ -292,6 +359,9 @@ class TokenTable:
         self.local_token_widths = {}
 
         self.point_tokens = []
+
+        # Names of functions with a POINT token in their FOOTER
+        self.point_footer_functions = set()
         # self.point_token_width = None
         self.point_token_width = 1
 
@@ -304,6 +374,9 @@ class TokenTable:
         self.point_token.id = None
         self.point_token.width = None
 
+        # Decode tables compiled on demand for each calling context
+        self.decode_tables = {}
+
 
         rlis_lines = open(rlis_file, "r")
         for line in rlis_lines:
@@ -331,9 +404,7 @@ class TokenTable:
             self.global_tokens[token.id] = token
         else:
             for offset in range(token.range):
-                resolved_token = copy.copy(token)
-                resolved_token.id = token.id + offset
-                self.global_tokens[resolved_token.id] = resolved_token
+                self.global_tokens[token.id + offset] = RlisEntryOffset(token, offset)
 
         return
 
@@ -354,9 +425,7 @@ class TokenTable:
             local_token_tables[token.id] = token
         else:
             for offset in range(token.range):
-                resolved_token = copy.copy(token)
-                resolved_token.id = token.id + offset
-                local_token_tables[resolved_token.id] = resolved_token
+                local_token_tables[token.id + offset] = RlisEntryOffset(token, offset)
 
         return
 
@@ -374,6 +443,8 @@ class TokenTable:
         # are no safety checks to see if a POINT token in defined
         # multiple times.
         self.point_tokens.append(token)
+        if token.type == RlisEntry.FOOTER:
+            self.point_footer_functions.add(token.function_name)
 
         return
 
@@ -381,11 +452,7 @@ class TokenTable:
     def has_point_footer(self, function_name):
         """Check for a POINT token in the FOOTER of function_name."""
 
-        for token in self.point_tokens:
-            if token.function_name == function_name and \
-                    token.type == RlisEntry.FOOTER:
-                return True
-        return False
+        return function_name in self.point_footer_functions
 
 
     def get_token(self, scope, token_id, context):
@@ -404,26 +471,141 @@ class TokenTable:
         return token
 
 
-    def __str__(self):
-        """Print token tables."""
-        out_string = ""
+    def get_decode_table(self, context):
+        """Return (table_width, table) used to decode tokens in context.
+
+        The table is indexed by the next table_width bits of the log.
+        Each entry is either None for bits that do not start a valid
+        token, or the tuple:
+            (bits consumed, token, stack action, name to push)
+        where the stack action is one of STACK_NONE, STACK_POP, or
+        STACK_PUSH.  Watch data following a token is not included in the
+        bits consumed.  If the table would be wider than
+        MAX_DECODE_TABLE_WIDTH then (None, None) is returned.
+
+        Contexts without local tokens all share a single table.
+        """
+
+        if not context in self.local_token_tables:
+            context = None
+        if context in self.decode_tables:
+            return self.decode_tables[context]
+
+        # Collect (preamble, preamble width, id width, tokens) for each
+        # scope that may be decoded in this context
+        scopes = []
+        if self.global_tokens:
+            scopes.append((RlisEntry.GLOBAL_PREAMBLE,
+                RlisEntry.GLOBAL_PREAMBLE_WIDTH, self.global_token_width,
+                self.global_tokens))
+        if context != None:
+            scopes.append((RlisEntry.LOCAL_PREAMBLE,
+                RlisEntry.LOCAL_PREAMBLE_WIDTH,
+                self.local_token_widths[context],
+                self.local_token_tables[context]))
+
+        table_width = max([RlisEntry.MAX_PREAMBLE_WIDTH,
+            RlisEntry.POINT_PREAMBLE_WIDTH + self.point_token_width - 1] +
+            [preamble_width + id_width for
+                (preamble, preamble_width, id_width, tokens) in scopes])
+
+        if table_width > self.MAX_DECODE_TABLE_WIDTH:
+            self.decode_tables[context] = (None, None)
+            return self.decode_tables[context]
+
+        table = [None] * (1 << table_width)
+
+        # Point tokens start with the point preamble and pop the stack
+        self._fill_decode_table(table, table_width,
+                RlisEntry.POINT_PREAMBLE, RlisEntry.POINT_PREAMBLE_WIDTH,
+                (self.point_token_width, self.point_token,
+                    self.STACK_POP, None))
+
+        for (preamble, preamble_width, id_width, tokens) in scopes:
+            for (id, token) in tokens.items():
+                if token.type == RlisEntry.HEADER and \
+                        token.scope == RlisEntry.GLOBAL:
+                    action = (self.STACK_PUSH, token.function_name)
+                elif token.type == RlisEntry.CALL and \
+                        self.has_point_footer(token.target):
+                    # Only update call stack for calls to ROI functions
+                    action = (self.STACK_PUSH, token.target)
+                else:
+                    action = (self.STACK_NONE, None)
+
+                self._fill_decode_table(table, table_width,
+                        (preamble << id_width) | id,
+                        preamble_width + id_width,
+                        (preamble_width + id_width, token) + action)
+
+        self.decode_tables[context] = (table_width, table)
+        return self.decode_tables[context]
+
+
+    def _fill_decode_table(self, table, table_width, prefix, prefix_width,
+            entry):
+        """Set entry for every table index starting with prefix."""
+
+        shift = table_width - prefix_width
+        start = prefix << shift
+        table[start:start + (1 << shift)] = [entry] * (1 << shift)
+        return
+
+
+    def write(self, out):
+        """Write the token tables to the file object out."""
 
         if self.point_tokens:
-            out_string += "---- Point Tokens (width %d): ----\n" % (self.point_token_width)
+            out.write("---- Point Tokens (width %d): ----\n" % (self.point_token_width))
             for token in self.point_tokens:
-                out_string += str(token)
+                out.write(str(token))
 
         if self.global_tokens:
-            out_string += "---- Global Tokens (width %d): ----\n" % (self.global_token_width)
+            out.write("---- Global Tokens (width %d): ----\n" % (self.global_token_width))
             for token in self.global_tokens.values():
-                out_string += str(token)
+                out.write(str(token))
 
         for function_name in self.local_token_tables.keys():
-            out_string += "---- Local Token Table for %s (width %d) ----\n" % (
-                    function_name, self.local_token_widths[function_name])
+            out.write("---- Local Token Table for %s (width %d) ----\n" % (
+                    function_name, self.local_token_widths[function_name]))
             for token in self.local_token_tables[function_name].values():
-                out_string += str(token)
-        return out_string
+                out.write(str(token))
+
+
+    def __str__(self):
+        """Print token tables."""
+        out = cStringIO.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+
+# Version of the compiled token table cache format.  Increment this
+# whenever RlisEntry or TokenTable change in a way that invalidates
+# previously pickled tables.
+CACHE_VERSION = 3
+
+def load_token_table(rlis_file, use_cache=True):
+    """Return the TokenTable for rlis_file.
+
+    Compiled token tables are cached next to rlis_file in a file with
+    the suffix ".cache".  The cache records CACHE_VERSION and a hash of
+    the contents of rlis_file and is only used when both match.
+    Otherwise the table is rebuilt from rlis_file and the cache is
+    rewritten.  See sideFile for how the cache is read and written.
+    """
+
+    if not use_cache:
+        return TokenTable(rlis_file)
 
+    rlis = open(rlis_file, "rb")
+    digest = hashlib.sha1(rlis.read()).hexdigest()
+    rlis.close()
+    cache_file = rlis_file + ".cache"
 
+    cached = sideFile.load_pickle(cache_file, CACHE_VERSION)
+    if cached != None and cached[0] == digest:
+        return cached[1]
 
+    token_table = TokenTable(rlis_file)
+    sideFile.save_pickle(cache_file, CACHE_VERSION, (digest, token_table))
+    return token_table
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Regents of the University of California
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# * Neither the name of the University of California, Los Angeles
+# nor the names of its contributors may be used to endorse or
+# promote products derived from this software without specific prior
+# written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Author: Roy Shea
+
+"""Side files written next to the inputs of the LIS tools.
+
+Several tools save derived data next to the files they are given so
+that later runs can skip work:
+
+- rlisTokens.py caches compiled token tables in "<rlis>.cache"
+- traceIndex.py indexes traces in "<trace>.idx"
+- calldata.py caches parsed call graphs in the file named by its -c
+  option
+
+These files are written into the same directory as the user's inputs,
+including the example inputs under demo/.  They are only an
+optimization: they may be deleted at any time, are rebuilt when missing
+or stale, and failure to read or write them is not an error.
+"""
+
+import os
+import cPickle
+
+# Errors raised by cPickle.load on a truncated or corrupt file or on a
+# file written by an incompatible version of the tools
+PICKLE_ERRORS = (EOFError, cPickle.UnpicklingError, ValueError, TypeError,
+        AttributeError, ImportError, IndexError, KeyError)
+
+
+def write_atomic(file_name, write):
+    """Call write with an open temporary file and move it to file_name.
+
+    The temporary file is moved into place only once it is complete, so
+    concurrent runs never see a partial side file.  Returns False if
+    file_name could not be written.
+    """
+
+    tmp_file = "%s.%d" % (file_name, os.getpid())
+    try:
+        side = open(tmp_file, "wb")
+        try:
+            write(side)
+        finally:
+            side.close()
+        os.rename(tmp_file, file_name)
+    except (IOError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
+    return True
+
+
+def save_pickle(file_name, version, data):
+    """Pickle data tagged with version into file_name."""
+
+    return write_atomic(file_name, lambda side: cPickle.dump((version, data),
+        side, cPickle.HIGHEST_PROTOCOL))
+
+
+def load_pickle(file_name, version):
+    """Return the data saved by save_pickle in file_name.
+
+    Returns None if file_name is missing, can not be unpickled, or was
+    saved with a different version.
+    """
+
+    try:
+        side = open(file_name, "rb")
+    except IOError:
+        return None
+
+    try:
+        saved = cPickle.load(side)
+    except PICKLE_ERRORS:
+        return None
+    finally:
+        side.close()
+
+    if type(saved) != tuple or len(saved) != 2 or saved[0] != version:
+        return None
+    return saved[1]
+
+
+if __name__ == '__main__':
+    assert False, "Side files are written by the tools that use them."
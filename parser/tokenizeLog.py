@@ -35,6 +35,7 @@
 
 # Author: Roy Shea
 
+import sys
 from optparse import OptionParser
 import rlisTokens
 import packet
@@ -55,11 +56,9 @@ def serialize_tokens(node_id, tokens):
         if not token:
             out_items.append(reset)
             continue
-        elif type(token) == tuple:
-            # TODO: Badness to deal with possible tuple generated by
-            # the watch token type.
-            data = token[1]
-            token = token[0]
+        elif isinstance(token, rlisTokens.WatchEvent):
+            data = token.data
+            token = token.token
 
         if token.type == rlisTokens.RlisEntry.FOOTER:
             out_items.append(up)
@@ -101,7 +100,7 @@ def main():
 
     parser.add_option("-m", "--mode", dest="mode", metavar="STRING",
             default="system", help="Specify the trace mode that " +
-            "may be either network or system [default: %default]")
+            "may be network, system, or binary [default: %default]")
 
     parser.add_option("-n", "--node", dest="node_id", default=None,
             type="int", help="Only print trace for node with specified " +
@@ -111,6 +110,14 @@ def main():
             dest="verbose", help="Print full token data rather than " +
             "the standard token trace")
 
+    parser.add_option("-j", "--jobs", dest="jobs", default=1,
+            type="int", help="Number of processes used to tokenize " +
+            "the traces [default: %default]")
+
+    parser.add_option("--no-cache", action="store_false", dest="use_cache",
+            default=True, help="Do not read or write side files such " +
+            "as the compiled token table")
+
     (options, args) = parser.parse_args()
 
     if len(args) != 2:
@@ -118,42 +125,37 @@ def main():
     (rlis_file, trace_file) = args
 
     # Read in the packets and make list of bitlog packets
-    if options.mode == "network":
-        packet_class = packet.AMPacket
-    elif options.mode == "system":
-        packet_class = packet.SystemPacket
-    else:
-        parser.error("option -m must be either network or system")
-    packets = packet.read_packets(trace_file, packet_class)
+    if options.mode not in packet.TRACE_MODES:
+        parser.error("option -m must be one of network, system, or binary")
+    packets = packet.read_trace(trace_file, options.mode)
     bitlog_packets = packet.BitlogPacket.get_bitlog_packets(packets)
 
     # Create a source trace from the packets
-    bitlog_traces = packetTrace.SourceTrace(bitlog_packets)
+    bitlog_traces = packetTrace.SpooledTraces(bitlog_packets)
 
     # Load the token table and the parser
-    token_table = rlisTokens.TokenTable(rlis_file)
+    token_table = rlisTokens.load_token_table(rlis_file,
+            options.use_cache)
     roi_parser = parseLog.RoiParser(token_table)
 
     # Tokenize the stream for each node
-    node_tokens = {}
     start_time = bitlog_traces.get_start_time()
-    for trace_id in sorted(bitlog_traces.traces.keys()):
-        trace = bitlog_traces.traces[trace_id]
-        tokens_and_times = roi_parser.tokenize_trace(trace, start_time)
-        [tokens, times] = zip(*tokens_and_times)
-        node_tokens[trace_id] = tokens
+    columns = roi_parser.tokenize_columns(bitlog_traces.traces, start_time,
+            options.jobs)
 
 
-    for id in sorted(node_tokens.keys()):
+    for id in columns.trace_ids():
 
         # If node_id is specified then skip non-node_id nodes
         if options.node_id and id != options.node_id: pass
 
         # Print the output
         if not options.verbose:
-            print " ".join(serialize_tokens(id, node_tokens[id]))
+            print " ".join(serialize_tokens(id, columns.trace_tokens(id)))
         else:
-            print print_tokens(id, node_tokens[id])
+            print print_tokens(id, columns.trace_tokens(id))
+
+    bitlog_traces.write_dropped(sys.stderr)
 
 
 if __name__ == '__main__':
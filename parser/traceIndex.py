@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009, Regents of the University of California
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# * Neither the name of the University of California, Los Angeles
+# nor the names of its contributors may be used to endorse or
+# promote products derived from this software without specific prior
+# written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Author: Roy Shea
+
+import os
+import sys
+import mmap
+import array
+import bisect
+import struct
+
+import packet
+import sideFile
+
+
+class TraceIndex:
+    """Index of the bitlog packets within a trace file.
+
+    For every bitlog packet the index records the byte offset of the
+    packet within the trace file, its source address, sequence number,
+    and timestamp.  Packets from one source or one window of time can
+    then be read directly from a memory map of the trace without
+    parsing the rest of the file.
+
+    The positions of the packets from each source are stored grouped
+    by source along with their timestamps, so a source and time window
+    is found by bisection without a pass over the packets.  The earliest
+    timestamp is kept in the header.
+
+    The index is saved next to the trace with the suffix ".idx" and is
+    rebuilt whenever the size or modification time of the trace changes.
+    """
+
+    MAGIC = "LISX"
+    VERSION = 3
+    HEADER = struct.Struct("<4sB8sQdQQd")
+
+    def __init__(self, trace_file, mode, use_cache=True):
+        """Load or build the index for trace_file.
+
+        The mode is the trace mode used by parseLog.py and must be one
+        of packet.TRACE_MODES.  If use_cache is False then the index is
+        built without reading or saving the index file.
+        """
+
+        self.trace_file = trace_file
+        self.index_file = trace_file + ".idx"
+        self.mode = mode
+        self.packet_class = packet.TRACE_MODES[mode]
+
+        # Parallel columns describing each indexed packet in file order
+        self.offsets = array.array("l")
+        self.sources = array.array("l")
+        self.seq_nums = array.array("B")
+        self.timestamps = array.array("d")
+
+        # Positions of the packets grouped by source in file order.  The
+        # packets of source_addrs[i] are source_order[source_starts[i]:
+        # source_starts[i + 1]] and source_times holds their timestamps.
+        self.source_addrs = array.array("l")
+        self.source_starts = array.array("l")
+        self.source_order = array.array("l")
+        self.source_times = array.array("d")
+
+        # Earliest timestamp of an indexed packet, or None
+        self.start_time = None
+
+        stat = os.stat(trace_file)
+        self.trace_size = stat.st_size
+        self.trace_mtime = stat.st_mtime
+
+        if not use_cache or not self._load():
+            self._build()
+            self._group_sources()
+            if use_cache:
+                self._save()
+
+        self.source_ranges = {}
+        for i in range(len(self.source_addrs)):
+            self.source_ranges[self.source_addrs[i]] = \
+                    (self.source_starts[i], self.source_starts[i + 1])
+
+
+    def _build(self):
+        """Scan the full trace to build the index."""
+
+        trace_map = self._open_map()
+        if trace_map == None:
+            return
+
+        if self.packet_class:
+            records = self._scan_lines(trace_map)
+        else:
+            binary_trace = packet.BinaryTrace(self.trace_file)
+            records = ((record[0], binary_trace.packet_at(*record[1:]))
+                    for record in binary_trace.records())
+
+        for (offset, p) in records:
+            if not packet.BitlogPacket.is_bitlog_packet(p):
+                continue
+            bitlog_packet = packet.BitlogPacket(p)
+            self.offsets.append(offset)
+            self.sources.append(bitlog_packet.src_addr)
+            self.seq_nums.append(bitlog_packet.seq_num)
+            if bitlog_packet.timestamp == None:
+                self.timestamps.append(float("nan"))
+            else:
+                self.timestamps.append(bitlog_packet.timestamp)
+                if self.start_time == None or \
+                        bitlog_packet.timestamp < self.start_time:
+                    self.start_time = bitlog_packet.timestamp
+
+        if not self.packet_class:
+            binary_trace.close()
+        trace_map.close()
+
+
+    def _group_sources(self):
+        """Fill the source columns from the packet columns."""
+
+        grouped = {}
+        for position in range(len(self.sources)):
+            grouped.setdefault(self.sources[position], []).append(position)
+
+        for source in sorted(grouped.keys()):
+            self.source_addrs.append(source)
+            self.source_starts.append(len(self.source_order))
+            self.source_order.extend(grouped[source])
+        self.source_starts.append(len(self.source_order))
+
+        timestamps = self.timestamps
+        self.source_times.extend([timestamps[position]
+            for position in self.source_order])
+
+
+    def _scan_lines(self, trace_map):
+        """Generate (offset, packet) for each valid line of a trace."""
+
+        offset = 0
+        line_number = 0
+        while offset < len(trace_map):
+            line = trace_map.readline()
+            line_number += 1
+            try:
+                yield (offset, self.packet_class(line))
+            except packet.PacketFormatError, e:
+                sys.stderr.write("Skipping line %d: %s\n" %
+                        (line_number, e.value))
+            offset = trace_map.tell()
+
+
+    def _open_map(self):
+        """Return a read only memory map of the trace, or None if empty."""
+
+        if self.trace_size == 0:
+            return None
+        trace = open(self.trace_file, "rb")
+        trace_map = mmap.mmap(trace.fileno(), 0, access=mmap.ACCESS_READ)
+        trace.close()
+        return trace_map
+
+
+    def _load(self):
+        """Load a saved index.  Returns False if it is missing or stale."""
+
+        try:
+            index = open(self.index_file, "rb")
+        except IOError:
+            return False
+
+        try:
+            header = index.read(self.HEADER.size)
+            if len(header) != self.HEADER.size:
+                return False
+            (magic, version, mode, size, mtime, count, source_count,
+                    start_time) = self.HEADER.unpack(header)
+            if magic != self.MAGIC or version != self.VERSION or \
+                    mode.rstrip("\0") != self.mode or \
+                    size != self.trace_size or mtime != self.trace_mtime:
+                return False
+            for column in self._columns():
+                column.fromfile(index, count)
+            self.source_addrs.fromfile(index, source_count)
+            self.source_starts.fromfile(index, source_count + 1)
+            self.source_order.fromfile(index, count)
+            self.source_times.fromfile(index, count)
+            if start_time == start_time:
+                self.start_time = start_time
+        except (EOFError, IOError, struct.error):
+            for column in self._columns() + self._source_columns():
+                del column[:]
+            return False
+        finally:
+            index.close()
+
+        return True
+
+
+    def _save(self):
+        """Save the index next to the trace if possible."""
+
+        sideFile.write_atomic(self.index_file, self._write)
+        return
+
+
+    def _write(self, index):
+        """Write the index to the open file index."""
+
+        index.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.mode,
+            self.trace_size, self.trace_mtime, len(self.offsets),
+            len(self.source_addrs), self._stored_start_time()))
+        for column in self._columns() + self._source_columns():
+            column.tofile(index)
+
+
+    def _stored_start_time(self):
+        """Return the start time to store, which is NaN if missing."""
+
+        if self.start_time == None:
+            return float("nan")
+        return self.start_time
+
+
+    def _columns(self):
+        return (self.offsets, self.sources, self.seq_nums, self.timestamps)
+
+
+    def _source_columns(self):
+        return (self.source_addrs, self.source_starts, self.source_order,
+                self.source_times)
+
+
+    def get_start_time(self):
+        """Return the earliest timestamp in the trace, or None."""
+        return self.start_time
+
+
+    def select(self, source=None, start=None, end=None):
+        """Return file order positions of the packets to read.
+
+        Packets are limited to those from the source address source and
+        with timestamps between start and end inclusive.  A value of None
+        places no limit.  Timestamps are assumed to increase through the
+        trace, as they do for listener output.
+        """
+
+        if source == None:
+            times = self.timestamps
+            (first, last) = (0, len(times))
+        else:
+            times = self.source_times
+            (first, last) = self.source_ranges.get(source, (0, 0))
+
+        if start != None:
+            first = bisect.bisect_left(times, start, first, last)
+        if end != None:
+            last = bisect.bisect_right(times, end, first, last)
+
+        if source == None:
+            return range(first, last)
+        return self.source_order[first:last].tolist()
+
+
+    def packets(self, source=None, start=None, end=None):
+        """Generate the packets selected by select using a memory map."""
+
+        positions = self.select(source, start, end)
+        if not positions:
+            return
+
+        if self.packet_class:
+            trace_map = self._open_map()
+            try:
+                for position in positions:
+                    offset = self.offsets[position]
+                    line_end = trace_map.find("\n", offset)
+                    if line_end < 0:
+                        line_end = len(trace_map)
+                    yield self.packet_class(trace_map[offset:line_end])
+            finally:
+                trace_map.close()
+        else:
+            binary_trace = packet.BinaryTrace(self.trace_file)
+            try:
+                for position in positions:
+                    yield binary_trace.read_packet(self.offsets[position])
+            finally:
+                binary_trace.close()
+
+
+if __name__ == '__main__':
+    assert False, "Stick a fork in it 'cause you're done."
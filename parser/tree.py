@@ -35,6 +35,9 @@
 
 # Author: Roy Shea
 
+import sys
+import array
+import cStringIO
 from optparse import OptionParser
 import rlisTokens
 import packet
@@ -114,17 +117,15 @@ class CallTree:
             # Examine token to see if it is:
             # - None indicating missing data.  Need to continue next
             #   building tree using next token from the root.
-            # - Tuple indicating a watch token with data.  Need to separate
-            #   out the two pieces of information.
+            # - WatchEvent indicating a watch token with data.  Need to
+            #   separate out the two pieces of information.
             # - Normal case is just a token.
             if not token:
                 node = self.get_root()
                 continue
-            elif type(token) == tuple:
-                # TODO: Badness to deal with possible tuple generated by
-                # the watch token type.
-                data = token[1]
-                token = token[0]
+            elif isinstance(token, rlisTokens.WatchEvent):
+                data = token.data
+                token = token.token
 
             # Add the token to the tree!
             if token.type == rlisTokens.RlisEntry.FOOTER:
@@ -161,13 +162,31 @@ class CallTree:
         self._print_list_stats([b for b in self.branch_sizes() if b != 0])
 
 
+    def write(self, out):
+        """Write the tree in DOT form to the file object out.
+
+        Each node is written, then each of its subtrees followed by the
+        edge to that subtree.  The stack holds the nodes still to write
+        and the (parent, child) edges to write once a subtree is done.
+        """
+
+        stack = [(self, None)]
+        while stack:
+            (node, edge_parent) = stack.pop()
+            if edge_parent != None:
+                out.write("%s -> %s\n" % (edge_parent.node_id, node.node_id))
+                continue
+
+            out.write("%s\n" % node.node_id)
+            for child in reversed(node.children.values()):
+                stack.append((child, node))
+                stack.append((child, None))
+
+
     def __str__(self):
-        out_string = ""
-        out_string += "%s\n" % self.node_id
-        for (child_id, child) in self.children.items():
-            out_string += str(child)
-            out_string += "%s -> %s\n" % (self.node_id, child.node_id)
-        return out_string
+        out = cStringIO.StringIO()
+        self.write(out)
+        return out.getvalue()
 
 
 class FullCallTree(CallTree):
@@ -219,7 +238,7 @@ class FullCallTree(CallTree):
                     self._next_tree_counter(), token.id)
 
         elif token.type == rlisTokens.RlisEntry.WATCH:
-            assert data, "Data must not be None for watch points"
+            assert data != None, "Data must not be None for watch points"
             id = "%s_%d_watch_%d_val_%d" % (token.function_name,
                     self._next_tree_counter(), token.id, data)
 
@@ -246,6 +265,179 @@ class OverlayCallTree(FullCallTree):
         return child
 
 
+class AggregateCallTree:
+    """Calling context tree aggregating every call along the same path.
+
+    Like OverlayCallTree, each distinct path of calls from the root is a
+    single node, but nodes also count how often the path was taken and
+    the total time spent within it.  Node labels are interned to integer
+    ids and nodes are stored in flat arrays indexed by node number, with
+    the root as node 0.  Children are found through a dictionary keyed
+    on (parent, label id) rather than by scanning the children.
+
+    As in parseLog.py, a CALL only enters the called function if that
+    function has a POINT token in its FOOTER to mark its return.
+    """
+
+    ROOT = 0
+
+    def __init__(self, token_table):
+
+        self.token_table = token_table
+
+        # Interned node labels
+        self.labels = []
+        self.label_ids = {}
+
+        # Per-node columns
+        self.parent = array.array("l")
+        self.label = array.array("l")
+        self.first_child = array.array("l")
+        self.last_child = array.array("l")
+        self.next_sibling = array.array("l")
+        self.counts = array.array("l")
+        self.total_time = array.array("d")
+
+        # Node number keyed by (parent, label id)
+        self.children = {}
+
+        self._add_node(-1, self._intern("root"))
+
+
+    def _intern(self, label):
+
+        label_id = self.label_ids.get(label)
+        if label_id == None:
+            label_id = len(self.labels)
+            self.labels.append(label)
+            self.label_ids[label] = label_id
+        return label_id
+
+
+    def _add_node(self, parent, label_id):
+
+        node = len(self.parent)
+        self.parent.append(parent)
+        self.label.append(label_id)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.counts.append(0)
+        self.total_time.append(0.0)
+
+        if parent >= 0:
+            self.children[(parent, label_id)] = node
+            if self.first_child[parent] < 0:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[self.last_child[parent]] = node
+            self.last_child[parent] = node
+        return node
+
+
+    def visit_child(self, parent, label):
+        """Count a visit to the child of parent with label and return it."""
+
+        label_id = self._intern(label)
+        node = self.children.get((parent, label_id))
+        if node == None:
+            node = self._add_node(parent, label_id)
+        self.counts[node] += 1
+        return node
+
+
+    def num_nodes(self):
+        return len(self.parent)
+
+
+    def build_from_tokens(self, tokens_and_times):
+        """Add the calls in (token, time_and_offset) pairs to the tree."""
+
+        node = self.ROOT
+
+        # Start times of the calls leading to node
+        start_times = []
+
+        for (token, time_and_offset) in tokens_and_times:
+
+            # Missing data restarts the tree from the root
+            if not token:
+                node = self.ROOT
+                start_times = []
+                continue
+            elif isinstance(token, rlisTokens.WatchEvent):
+                data = token.data
+                token = token.token
+            time = time_and_offset[0]
+
+            if token.type == rlisTokens.RlisEntry.FOOTER:
+                if node != self.ROOT:
+                    self.total_time[node] += time - start_times.pop()
+                    node = self.parent[node]
+
+            elif token.type == rlisTokens.RlisEntry.HEADER:
+                node = self.visit_child(node, token.function_name)
+                start_times.append(time)
+
+            elif token.type == rlisTokens.RlisEntry.CALL:
+                if self.token_table.has_point_footer(token.target):
+                    node = self.visit_child(node, token.target)
+                    start_times.append(time)
+                else:
+                    self.visit_child(node, token.target)
+
+            elif token.type == rlisTokens.RlisEntry.CONDITIONAL:
+                self.visit_child(node, "%s_branch_%d" %
+                        (token.function_name, token.id))
+
+            elif token.type == rlisTokens.RlisEntry.WATCH:
+                self.visit_child(node, "%s_watch_%d_val_%d" %
+                        (token.function_name, token.id, data))
+
+            else:
+                assert False, "Unexpected token type"
+
+
+    def _node_id(self, node):
+        if node == self.ROOT:
+            return "root"
+        return "%s_%d" % (self.labels[self.label[node]], node)
+
+
+    def write(self, out):
+        """Write the tree in the same DOT form as CallTree.write with the
+        visit count and total time of each node attached as labels.
+        """
+
+        stack = [(self.ROOT, None)]
+        while stack:
+            (node, edge_parent) = stack.pop()
+            if edge_parent != None:
+                out.write("%s -> %s [label=\"%d\"]\n" % (
+                    self._node_id(edge_parent), self._node_id(node),
+                    self.counts[node]))
+                continue
+
+            out.write("%s [label=\"%s\\ncount %d, %f s\"]\n" % (
+                self._node_id(node), self.labels[self.label[node]],
+                self.counts[node], self.total_time[node]))
+
+            children = []
+            child = self.first_child[node]
+            while child >= 0:
+                children.append(child)
+                child = self.next_sibling[child]
+            for child in reversed(children):
+                stack.append((child, node))
+                stack.append((child, None))
+
+
+    def __str__(self):
+        out = cStringIO.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+
 def main():
 
     # Handle the command line
@@ -254,12 +446,24 @@ def main():
 
     parser.add_option("-m", "--mode", dest="mode", metavar="STRING",
             default="network", help="Specify the trace mode that " +
-            "may be either network or system [default: %default]")
+            "may be network, system, or binary [default: %default]")
 
     parser.add_option("-s", "--spread", action="store_true",
             dest="spread", help="Output a fully spread tree, rather than " +
             "overlaying similar calls")
 
+    parser.add_option("-a", "--aggregate", action="store_true",
+            dest="aggregate", help="Output a calling context tree with " +
+            "the number of calls and time spent along each path")
+
+    parser.add_option("-j", "--jobs", dest="jobs", default=1,
+            type="int", help="Number of processes used to tokenize " +
+            "the traces [default: %default]")
+
+    parser.add_option("--no-cache", action="store_false", dest="use_cache",
+            default=True, help="Do not read or write side files such " +
+            "as the compiled token table")
+
     (options, args) = parser.parse_args()
 
     if len(args) != 2:
@@ -267,28 +471,34 @@ def main():
     (rlis_file, trace_file) = args
 
     # Load the token table and the parser
-    token_table = rlisTokens.TokenTable(rlis_file)
+    token_table = rlisTokens.load_token_table(rlis_file,
+            options.use_cache)
     roi_parser = parseLog.RoiParser(token_table)
 
     # Read in the packets and make list of bitlog packets
-    if options.mode == "network":
-        packet_class = packet.AMPacket
-    elif options.mode == "system":
-        packet_class = packet.SystemPacket
-    else:
-        parser.error("option -m must be either network or system")
-    packets = packet.read_packets(trace_file, packet_class)
+    if options.mode not in packet.TRACE_MODES:
+        parser.error("option -m must be one of network, system, or binary")
+    packets = packet.read_trace(trace_file, options.mode)
     bitlog_packets = packet.BitlogPacket.get_bitlog_packets(packets)
 
     # Create a source trace from the packets
-    bitlog_traces = packetTrace.SourceTrace(bitlog_packets)
+    bitlog_traces = packetTrace.SpooledTraces(bitlog_packets)
 
     # Print tokens
-    start_time = bitlog_traces.traces[0][0].timestamp
-    for trace_id in sorted(bitlog_traces.traces.keys()):
+    start_time = bitlog_traces.get_start_time()
+    for (trace_id, tokens_and_times) in roi_parser.tokenize_traces(
+            bitlog_traces.traces, start_time, options.jobs):
         print "# ==== Trace for node %d ====" % (trace_id)
-        trace = bitlog_traces.traces[trace_id]
-        tokens_and_times = roi_parser.tokenize_trace(trace, start_time)
+
+        if options.aggregate:
+            tree = AggregateCallTree(token_table)
+            tree.build_from_tokens(tokens_and_times)
+            print "digraph {"
+            tree.write(sys.stdout)
+            print
+            print "}"
+            continue
+
         [tokens, times] = zip(*tokens_and_times)
 
         if options.spread:
@@ -298,9 +508,12 @@ def main():
 
         tree.build_from_tokens(tokens)
         print "digraph {"
-        print str(tree)
+        tree.write(sys.stdout)
+        print
         print "}"
 
+    bitlog_traces.write_dropped(sys.stderr)
+
 
 if __name__ == '__main__':
     main()